@@ -8,145 +8,579 @@ Then process them here to post them to the micropub endpoint.
 
 """
 import argparse
+import codecs
+import glob
 import json
 import os
+import re
 import sys
+import time
 import base64
-from datetime import datetime
+import logging as log
+from datetime import datetime, time as dtime, timedelta
 
-from ugram import IGPost, Post, MicroPubSite, str2bool
+from ugram import (
+    IGPost, Post, MicroPubSite, Ledger, MediaCache, PlanWriter, IG_RATE,
+    MEDIA_WORKERS, PUBLISH_WINDOW, apply_plan, metrics, open_plan,
+    publish_in_order, report_failures, str2bool)
 
+HAR_CHUNK_SIZE = 1024 * 1024
+# Responses that can't be JSON, skipped before decoding their bodies
+NON_JSON_MIME_TYPES = ('image/', 'video/', 'audio/', 'font/', 'text/css')
+ENTRIES_RE = re.compile(r'"entries"\s*:\s*\[')
 
-def process_nodes(nodes: list[dict], start_date, end_date) -> list[dict]:
+# Key paths of the GraphQL connections that hold the profile posts. Used
+# with --prune to avoid walking the rest of every response body.
+TIMELINE_PATHS = (
+    ('data', 'xdt_api__v1__feed__user_timeline_graphql_connection'),
+)
+
+
+class NodeRecord:
+    """
+    The values of a node we care for. It reads like a dict so that IGPost
+    can take it as well as the ones parsed from the HTML pages.
+    """
+    __slots__ = ('code', 'created_at', 'text', 'image_url', 'video_url',
+                 'carousel_urls', 'is_video')
+
+    def __init__(self, code, created_at, text, image_url, video_url,
+                 carousel_urls):
+        self.code = code
+        self.created_at = created_at
+        self.text = text
+        self.image_url = image_url
+        self.video_url = video_url
+        self.carousel_urls = carousel_urls
+        self.is_video = bool(video_url)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['code'], data['created_at'], data['text'],
+                   data['image_url'], data['video_url'], data['carousel_urls'])
+
+
+def date_bounds(start_date, end_date):
+    """
+    :return: The epoch timestamps where the local dates start, inclusive, and
+        where the day after `end_date` starts, exclusive. A missing date
+        leaves that side open.
+    """
+    start, end = float('-inf'), float('inf')
+    if start_date is not None:
+        start = datetime.combine(start_date, dtime.min).timestamp()
+    if end_date is not None:
+        end = datetime.combine(end_date + timedelta(days=1),
+                               dtime.min).timestamp()
+    return start, end
+
+
+def process_nodes(nodes, start_date, end_date):
     """
     From the obtained nodes from the HAR file, extract the values we need
     to construct the IGPost() instances we want.
+
+    :return: Generator of the NodeRecord within the dates
     """
-    found = []
+    start, end = date_bounds(start_date, end_date)
     for data in nodes:
-        node = data["node"]
-        code = node.get('code')
+        with metrics.timer('filtering'):
+            result = compact_node(data["node"], start, end)
+        if result is not None:
+            metrics.count('filtered_nodes')
+            yield result
 
-        # 2. node.caption info
-        # Handle cases where caption might be None
-        caption_obj = node.get('caption') or {}
-        if not caption_obj:
-            continue
 
-        created_at = caption_obj.get('created_at')
-        captured_date = datetime.fromtimestamp(created_at).date()
-        if not (start_date <= captured_date <= end_date):
-            continue
+def compact_node(node, start, end):
+    """
+    :param start: Epoch timestamp the node can be created at, inclusive
+    :param end: Epoch timestamp the node must be created before
+    :return: The NodeRecord with the values of the node we care for, None
+        if it is outside of the dates.
+    """
+    # 1. node.caption.created_at, compared before extracting anything else
+    # Handle cases where caption might be None
+    caption_obj = node.get('caption') or {}
+    created_at = caption_obj.get('created_at')
+    if created_at is None or not (start <= created_at < end):
+        return None
+
+    code = node.get('code')
+
+    # 2. node.caption.text
+    text = caption_obj.get('text')
+
+    # 3. node.image_versions2.candidates[0].url
+    # Safely access nested lists/dicts
+    main_image_url = None
+    img_versions = node.get('image_versions2', {})
+    if img_versions and 'candidates' in img_versions:
+        candidates = img_versions['candidates']
+        if isinstance(candidates, list) and len(candidates) > 0:
+            main_image_url = candidates[0].get('url')
+
+    # 4. node.video_versions[0].url
+    main_video_url = None
+    vid_versions = node.get('video_versions')
+    if isinstance(vid_versions, list) and len(vid_versions) > 0:
+        main_video_url = vid_versions[0].get('url')
+
+    # 5. Carousel media
+    carousel_urls = []
+    carousel_media = node.get('carousel_media')
+    if isinstance(carousel_media, list):
+        for item in carousel_media:
+            c_img_vers = item.get('image_versions2', {})
+            c_cands = c_img_vers.get('candidates', [])
+            if isinstance(c_cands, list) and len(c_cands) > 0:
+                carousel_urls.append(c_cands[0].get('url'))
+
+    return NodeRecord(code, created_at, text, main_image_url, main_video_url,
+                      carousel_urls)
+
+
+def extract_nodes_from_json(data, paths=None):
+    """
+    Searches for objects containing a 'node' key within 'edges' lists.
+    Commonly in this data, they are inside a list under the key "edges".
 
-        text = caption_obj.get('text')
-
-        # 3. node.image_versions2.candidates[0].url
-        # Safely access nested lists/dicts
-        main_image_url = None
-        img_versions = node.get('image_versions2', {})
-        if img_versions and 'candidates' in img_versions:
-            candidates = img_versions['candidates']
-            if isinstance(candidates, list) and len(candidates) > 0:
-                main_image_url = candidates[0].get('url')
-
-        # 4. node.video_versions[0].url
-        main_video_url = None
-        vid_versions = node.get('video_versions')
-        if isinstance(vid_versions, list) and len(vid_versions) > 0:
-            main_video_url = vid_versions[0].get('url')
-
-        # 5. Carousel media
-        carousel_urls = []
-        carousel_media = node.get('carousel_media')
-        if isinstance(carousel_media, list):
-            for item in carousel_media:
-                c_img_vers = item.get('image_versions2', {})
-                c_cands = c_img_vers.get('candidates', [])
-                if isinstance(c_cands, list) and len(c_cands) > 0:
-                    carousel_urls.append(c_cands[0].get('url'))
-
-        # Build the small JSON
-        result = {
-            "code": code,
-            "created_at": created_at,
-            "text": text,
-            "image_url": main_image_url,
-            "video_url": main_video_url,
-            "carousel_urls": carousel_urls,
-            "is_video": bool(main_video_url),
-        }
-        found.append(result)
+    The tree is walked with an explicit stack and the edge wrappers are
+    yielded lazily, in document order. If `paths` is given, only the
+    connections found at those key paths are looked at, see
+    `TIMELINE_PATHS`.
+    """
+    if paths is not None:
+        for path in paths:
+            for connection in _resolve_path(data, path):
+                yield from _edge_nodes(connection)
+        return
+
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            yield from _edge_nodes(item)
+            children = item.values()
+        else:
+            children = item
+
+        nested = [v for v in children if isinstance(v, (dict, list))]
+        # Reversed so that siblings are popped in document order
+        stack.extend(reversed(nested))
 
-    return found
 
+def _edge_nodes(connection):
+    if not isinstance(connection, dict):
+        return
+    edges = connection.get('edges')
+    if isinstance(edges, list):
+        for edge in edges:
+            if isinstance(edge, dict) and 'node' in edge:
+                yield edge
 
-def extract_nodes_from_json(data):
+
+def _resolve_path(data, path):
     """
-    Recursively searches for objects containing a 'node' key within 'edges'
-    lists or just 'node' keys in general if they match the structure.
-    Commonly in this data, they are inside a list under the key "edges".
+    Returns the values found at the given key path. A "*" matches every
+    value of a dict or every item of a list.
     """
-    found = []
+    level = [data]
+    for key in path:
+        found = []
+        for item in level:
+            if key == '*':
+                if isinstance(item, dict):
+                    found.extend(item.values())
+                elif isinstance(item, list):
+                    found.extend(item)
+            elif isinstance(item, dict) and key in item:
+                found.append(item[key])
+        level = found
+    return level
+
+
+def iter_entry_nodes(entries, paths=None):
+    """
+    Given the entries of a HAR file, find the nodes inside the bodies of
+    those responses that contain the information from the IG posts.
+    """
+    for entry in entries:
+        metrics.count('har_entries')
+        with metrics.timer('har_decode'):
+            json_body = decode_entry_body(entry)
+        if json_body is None:
+            continue
+
+        # Extract matching nodes
+        with metrics.timer('node_extraction'):
+            nodes = list(extract_nodes_from_json(json_body, paths))
+        metrics.count('nodes', len(nodes))
+        yield from nodes
 
-    if isinstance(data, dict):
-        # Check if this dictionary has a 'node' key directly (and implies it's the wrapper)
-        # If we are iterating a list (like edges), the item itself is the wrapper.
-        # But here we are traversing.
-        if 'edges' in data and isinstance(data['edges'], list):
-            for edge in data['edges']:
-                if isinstance(edge, dict) and 'node' in edge:
-                    found.append(edge)
 
-        # Continue recursive search in all values
-        for key, value in data.items():
-            if isinstance(value, (dict, list)):
-                found.extend(extract_nodes_from_json(value))
+def decode_entry_body(entry):
+    """
+    :return: The decoded JSON response body of a HAR entry, None if it
+        doesn't have one.
+    """
+    response = entry.get('response', {})
+    content = response.get('content', {})
+    mime_type = content.get('mimeType', '')
+    body = content.get('text', '')
 
-    elif isinstance(data, list):
-        for item in data:
-            found.extend(extract_nodes_from_json(item))
+    if not body or mime_type.startswith(NON_JSON_MIME_TYPES):
+        return None
 
-    return found
+    # Handle base64 encoding if present (though rare for JSON text in HAR)
+    if content.get('encoding') == 'base64':
+        try:
+            body = base64.b64decode(body)
+        except Exception:
+            return None
+
+    # We are looking for JSON responses, sniffed before decoding any bytes
+    if 'json' not in mime_type and not looks_like_json(body):
+        return None
+    if isinstance(body, bytes):
+        # json.loads would decode the bytes to a str too, doing it here
+        # frees them before parsing.
+        body = body.decode('utf-8', errors='ignore')
+    try:
+        return json.loads(body)
+    except json.JSONDecodeError:
+        return None
 
 
-def process_har_file(har_data: dict) -> list[dict]:
+def looks_like_json(body):
+    """
+    Whether the first and last non-whitespace characters of the str or
+    bytes `body` are { and }, peeking at them without copying the body.
+    """
+    view = memoryview(body) if isinstance(body, bytes) else body
+    whitespace = b' \t\r\n' if isinstance(body, bytes) else ' \t\r\n'
+    opening, closing = (ord('{'), ord('}')) if isinstance(body, bytes) \
+        else ('{', '}')
+    start, end = 0, len(view) - 1
+    while start < end and view[start] in whitespace:
+        start += 1
+    while end > start and view[end] in whitespace:
+        end -= 1
+    return start < end and view[start] == opening and view[end] == closing
+
+
+def process_har_file(har_data: dict, paths=None) -> list[dict]:
     """
     Given a HAR file, find the nodes inside the bodies of those responses
     that contain the information from the IG posts.
     """
-    result_nodes = []
-    entries = har_data['log']['entries']
+    return list(iter_entry_nodes(har_data['log']['entries'], paths))
 
-    for entry in entries:
-        response = entry.get('response', {})
-        content = response.get('content', {})
-        mime_type = content.get('mimeType', '')
-        text = content.get('text', '')
 
-        if not text:
-            continue
+class HARReader:
+    """
+    Reads the `log.entries` array of a .har file one entry at a time, so
+    that memory is bounded by the largest single entry instead of the
+    whole archive.
+    """
 
-        # Handle base64 encoding if present (though rare for JSON text in HAR)
-        if content.get('encoding') == 'base64':
-            try:
-                text = base64.b64decode(text).decode('utf-8', errors='ignore')
-            except Exception:
+    def __init__(self, path, chunk_size=HAR_CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self):
+        """MB/s read from disk, including the time spent by the consumer."""
+        if not self.elapsed:
+            return 0.0
+        return self.bytes_read / (1024 * 1024) / self.elapsed
+
+    def _read(self, fh, decoder, size):
+        chunk = fh.read(size)
+        if not chunk:
+            return None
+        self.bytes_read += len(chunk)
+        return decoder.decode(chunk)
+
+    def entries(self):
+        json_decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder('utf-8')()
+        started = time.perf_counter()
+        try:
+            with open(self.path, 'rb') as fh:
+                yield from self._iter_entries(fh, json_decoder, utf8)
+        finally:
+            self.elapsed = time.perf_counter() - started
+
+    def _iter_entries(self, fh, json_decoder, utf8):
+        # Skip everything up to the opening bracket of `entries`
+        buf, pos = '', None
+        while pos is None:
+            chunk = self._read(fh, utf8, self.chunk_size)
+            if chunk is None:
+                return
+            buf += chunk
+            match = ENTRIES_RE.search(buf)
+            if match:
+                pos = match.end()
+            else:
+                # Keep a tail in case the key straddles two chunks
+                buf = buf[-64:]
+
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buf):
+                chunk = self._read(fh, utf8, self.chunk_size)
+                if chunk is None:
+                    return  # Truncated archive, keep what we got
+                buf, pos = chunk, 0
                 continue
+            if buf[pos] == ']':
+                return
 
-        # We are looking for JSON responses
-        if 'json' in mime_type or (
-                text.strip().startswith('{') and text.strip().endswith('}')):
             try:
-                json_body = json.loads(text)
+                entry, end = json_decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Entry not fully buffered yet. Grow the read size with the
+                # buffer so that huge entries don't get re-scanned per chunk.
+                size = max(self.chunk_size, len(buf) - pos)
+                chunk = self._read(fh, utf8, size)
+                if chunk is None:
+                    raise
+                buf, pos = buf[pos:] + chunk, 0
+                continue
 
-                # Extract matching nodes
-                nodes = extract_nodes_from_json(json_body)
-                result_nodes.extend(nodes)
+            yield entry
+            pos = end
+            if pos > self.chunk_size:
+                buf, pos = buf[pos:], 0
 
-            except json.JSONDecodeError:
+
+def stream_har_file(reader: HARReader, paths=None):
+    """
+    Same as `process_har_file` but yields the nodes as the entries are read
+    from disk.
+    """
+    return iter_entry_nodes(reader.entries(), paths)
+
+
+def node_richness(node):
+    """
+    Rough measure of how much of the post a compact node carries, used to
+    keep the best copy of a post captured in several archives.
+    """
+    return (
+        bool(node.get('text')),
+        len(node.get('carousel_urls') or ()),
+        bool(node.get('video_url')),
+        bool(node.get('image_url')),
+    )
+
+
+def merge_nodes(node_lists):
+    """
+    Merges the compact nodes found in several archives, keeping the richest
+    node per `code`, newest first as in a single archive.
+    """
+    by_code = {}
+    without_code = []
+    for nodes in node_lists:
+        for node in nodes:
+            code = node.get('code')
+            if code is None:
+                without_code.append(node)
                 continue
+            kept = by_code.get(code)
+            if kept is None or node_richness(node) > node_richness(kept):
+                by_code[code] = node
+
+    merged = sorted(by_code.values(), key=lambda node: node['created_at'],
+                    reverse=True)
+    return merged + without_code
+
+
+def expand_har_paths(patterns):
+    """
+    Expands the directories and glob patterns given in the command line
+    into the .har files they match.
+    """
+    found = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            found.extend(sorted(glob.glob(os.path.join(pattern, '*.har'))))
+        elif any(char in pattern for char in '*?['):
+            found.extend(sorted(glob.glob(pattern)))
+        else:
+            found.append(pattern)
+    return found
 
-    return result_nodes
+
+def load_har_nodes(path, start_date, end_date, stream=False, paths=None):
+    """
+    Reads a single HAR file into the compact nodes within the dates,
+    de-duplicated.
+
+    :return: Dict with the `nodes`, and the `bytes_read` and `elapsed`
+        seconds when streaming.
+    """
+    result = {'path': path, 'bytes_read': None, 'elapsed': None}
+    if stream:
+        reader = HARReader(path)
+        nodes = stream_har_file(reader, paths)
+        found = process_nodes(nodes, start_date, end_date)
+        result['nodes'] = merge_nodes([found])
+        # Read once merge_nodes has drained the generators
+        result['bytes_read'] = reader.bytes_read
+        result['elapsed'] = reader.elapsed
+    else:
+        with open(path, 'r', encoding='utf-8') as opened_f:
+            har_data = json.load(opened_f)
+        nodes = process_har_file(har_data, paths)
+        found = process_nodes(nodes, start_date, end_date)
+        result['nodes'] = merge_nodes([found])
+    return result
+
+
+def _load_har_nodes_worker(args):
+    """
+    load_har_nodes for the process pool, bringing the worker's metrics back.
+    """
+    with_metrics, args = args[0], args[1:]
+    metrics.enabled = with_metrics
+    metrics.timers, metrics.counters = {}, {}
+    result = load_har_nodes(*args)
+    result['metrics'] = (metrics.timers, metrics.counters)
+    return result
+
+
+def load_har_files(har_files, start_date, end_date, stream=False, paths=None,
+                   jobs=None):
+    """
+    Reads many HAR files in a process pool, one file per worker, so the
+    JSON decoding runs on every core. Only the compact nodes within the
+    dates travel back from the workers.
+
+    :return: The per file results of `load_har_nodes`, in order
+    """
+    jobs = min(jobs or os.cpu_count() or 1, len(har_files))
+    if jobs <= 1:
+        return [load_har_nodes(path, start_date, end_date, stream, paths)
+                for path in har_files]
+
+    from concurrent.futures import ProcessPoolExecutor
+    tasks = [(metrics.enabled, path, start_date, end_date, stream, paths)
+             for path in har_files]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(_load_har_nodes_worker, tasks))
+    for result in results:
+        metrics.merge(*result.pop('metrics'))
+    return results
+
+
+class NodeIndex:
+    """
+    sqlite3 store of the compact nodes found in the HAR files, indexed by
+    `created_at`, so that different date ranges over the same captures are
+    answered without decoding them again.
+
+    The HAR files are remembered by size and modification time, and only
+    new or changed files are read again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        import sqlite3
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS nodes (
+                    code TEXT PRIMARY KEY,
+                    created_at INTEGER NOT NULL,
+                    node TEXT NOT NULL
+                )
+            """)
+            self._db.execute("""
+                CREATE INDEX IF NOT EXISTS nodes_created_at
+                ON nodes (created_at)
+            """)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS sources (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL
+                )
+            """)
+
+    @staticmethod
+    def _signature(har_file):
+        stat = os.stat(har_file)
+        return stat.st_size, stat.st_mtime
+
+    def is_current(self, har_file):
+        """
+        :return: Whether the file is indexed and hasn't changed since.
+        """
+        row = self._db.execute(
+            "SELECT size, mtime FROM sources WHERE path = ?",
+            (os.path.abspath(har_file),)).fetchone()
+        return row is not None and tuple(row) == self._signature(har_file)
+
+    def add(self, har_file, nodes):
+        """
+        Stores the compact nodes read from `har_file`, keeping the richest
+        copy of the posts already indexed from other files.
+        """
+        skipped = 0
+        with self._db:
+            for node in nodes:
+                code = node.get('code')
+                if code is None:
+                    skipped += 1
+                    continue
+                row = self._db.execute(
+                    "SELECT node FROM nodes WHERE code = ?", (code,)
+                ).fetchone()
+                if row and node_richness(json.loads(row[0])) >= \
+                        node_richness(node):
+                    continue
+                self._db.execute(
+                    "INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)",
+                    (code, node.created_at, json.dumps(node.to_dict())))
+            self._db.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?)",
+                (os.path.abspath(har_file),) + self._signature(har_file))
+        if skipped:
+            log.debug("Not indexing %d nodes without a shortcode from %s",
+                      skipped, har_file)
+
+    def between(self, start_date, end_date):
+        """
+        :return: The nodes created between both dates, inclusive and in
+            local time, newest first.
+        """
+        rows = self._db.execute(
+            "SELECT node FROM nodes WHERE created_at >= ? AND created_at < ? "
+            "ORDER BY created_at DESC", date_bounds(start_date, end_date))
+        return [NodeRecord.from_dict(json.loads(row[0])) for row in rows]
+
+    def close(self):
+        self._db.close()
 
 
 def parse_date(date_str):
@@ -160,57 +594,154 @@ def parse_date(date_str):
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Process HAR file with config and date range.")
+        description="Process HAR files with config and date range.")
 
     parser.add_argument('config_file', help="Path to the config.json file")
-    parser.add_argument('har_file', help="Path to the input .har file")
+    parser.add_argument('har_files', nargs='*',
+                        help="Input .har files, directories or glob patterns")
 
-    parser.add_argument('--from', dest='start_date', type=parse_date,
-                        required=True)
-    parser.add_argument('--to', dest='end_date', type=parse_date, required=True)
+    parser.add_argument('--from', dest='start_date', type=parse_date)
+    parser.add_argument('--to', dest='end_date', type=parse_date)
     parser.add_argument('--commit', type=str2bool, nargs='?', const=True,
                         default=False)
     parser.add_argument('--syndicate', type=str2bool, nargs='?', const=True,
                         default=False)
+    parser.add_argument('--stream', type=str2bool, nargs='?', const=True,
+                        default=False)
+    parser.add_argument('--prune', type=str2bool, nargs='?', const=True,
+                        default=False)
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--index', default=None)
+    parser.add_argument('--media-workers', type=int, default=MEDIA_WORKERS)
+    parser.add_argument('--publish-window', type=int, default=PUBLISH_WINDOW)
+    parser.add_argument('--ledger', default=None)
+    parser.add_argument('--media-cache', default=None)
+    parser.add_argument('--ig-rate', type=float, default=IG_RATE)
+    parser.add_argument('--metrics', choices=['json', 'prometheus'],
+                        default=None)
+    parser.add_argument('--plan', default=None)
+    parser.add_argument('--apply', default=None)
+    parser.add_argument('--config-snapshot', default=None)
+    parser.add_argument('-v', '--verbose', action='store_true')
 
     args = parser.parse_args()
+    log.basicConfig(level=log.DEBUG if args.verbose else log.INFO)
+    metrics.enabled = bool(args.metrics)
 
     # --- Validations ---
-    json_contents = []
-    for f in [args.config_file, args.har_file]:
+    if args.apply:
+        if args.apply != '-' and not os.path.exists(args.apply):
+            sys.exit(f"❌ Error: File not found: {args.apply}")
+    elif not (args.start_date and args.end_date):
+        sys.exit("Error: --from and --to are required unless applying a plan.")
+    har_files = expand_har_paths(args.har_files)
+    if not args.har_files and not args.index and not args.apply:
+        sys.exit("Error: Give at least one .har file, or an --index.")
+    if args.har_files and not har_files:
+        sys.exit(f"Error: No .har files found in: {' '.join(args.har_files)}")
+    for f in [args.config_file] + har_files:
         if not os.path.exists(f):
             sys.exit(f"❌ Error: File not found: {f}")
 
-        try:
-            with open(f, 'r', encoding='utf-8') as opened_f:
-                json_contents.append(json.load(opened_f))
-        except json.JSONDecodeError:
-            print(f"Error: Failed to parse '{f}' as JSON.")
-            sys.exit(1)
-
-    if not args.har_file.lower().endswith('.har'):
-        sys.exit(
-            f"Error: The input file '{args.har_file}' must be a .har file.")
-
-    if args.start_date >= args.end_date:
+    try:
+        with open(args.config_file, 'r', encoding='utf-8') as opened_f:
+            config = json.load(opened_f)
+    except json.JSONDecodeError:
+        print(f"Error: Failed to parse '{args.config_file}' as JSON.")
+        sys.exit(1)
+
+    for har_file in har_files:
+        if not har_file.lower().endswith('.har'):
+            sys.exit(
+                f"Error: The input file '{har_file}' must be a .har file.")
+
+    if not args.apply and args.start_date >= args.end_date:
         sys.exit(f"Error: Start date must be before end date.")
 
     # Actual main execution
-    config, har_contents = json_contents
     mp_endpoint = config["endpoint"]
     token = config["token"]
-    site = MicroPubSite(mp_endpoint, token)
-
-    nodes = process_har_file(har_contents)
-    filtered_nodes = process_nodes(nodes, args.start_date, args.end_date)
+    ledger = Ledger(args.ledger) if args.ledger else None
+    media_cache = MediaCache(args.media_cache) if args.media_cache else None
+    site = MicroPubSite(mp_endpoint, token, args.media_workers, ledger,
+                        media_cache, args.ig_rate,
+                        config_snapshot=args.config_snapshot)
+
+    if args.apply:
+        # The plan has everything needed, the HAR files aren't read
+        with open_plan(args.apply, 'r') as apply_fh:
+            failures = apply_plan(site, apply_fh, args.publish_window)
+        finish(site, args, failures)
+        return
+
+    paths = TIMELINE_PATHS if args.prune else None
+    index = NodeIndex(args.index) if args.index else None
+    if index:
+        # Index every post in the files, the dates are queried afterwards
+        to_read = [f for f in har_files if not index.is_current(f)]
+        start_date = end_date = None
+    else:
+        to_read = har_files
+        start_date, end_date = args.start_date, args.end_date
+    try:
+        results = load_har_files(to_read, start_date, end_date, args.stream,
+                                 paths, args.jobs) if to_read else []
+    except json.JSONDecodeError as e:
+        print(f"Error: Failed to parse a .har file as JSON: {e}")
+        sys.exit(1)
+    for result in results:
+        if result['elapsed']:
+            mb_read = result['bytes_read'] / (1024 * 1024)
+            log.info("Read %.1f MB from %s in %.2fs (%.1f MB/s)", mb_read,
+                     result['path'], result['elapsed'],
+                     mb_read / result['elapsed'])
+
+    if index:
+        for result in results:
+            index.add(result['path'], result['nodes'])
+        log.info("Indexed %d new .har files, %d were up to date",
+                 len(results), len(har_files) - len(to_read))
+        with metrics.timer('index_query'):
+            filtered_nodes = index.between(args.start_date, args.end_date)
+        index.close()
+    else:
+        filtered_nodes = merge_nodes(result['nodes'] for result in results)
     ig_posts = [IGPost.from_filtered_node(n) for n in filtered_nodes]
     posts = [Post(ig, ig.publish_date) for ig in ig_posts]
-
-    for post in reversed(posts):  # Post older ones first
-        if args.commit:
-            post.post(site, args.syndicate)
-        else:
-            post.print(site, args.syndicate)
+    if ledger is not None:
+        unpublished = [p for p in posts if p.ig_post.code not in ledger]
+        if len(unpublished) < len(posts):
+            log.info("Skipping %d already published posts",
+                     len(posts) - len(unpublished))
+        posts = unpublished
+
+    failures = []
+    if args.commit:
+        # Post older ones first
+        failures = publish_in_order(
+            site, ((post, args.syndicate) for post in reversed(posts)),
+            args.publish_window)
+    else:
+        with open_plan(args.plan or '-', 'w') as plan_fh:
+            plan = PlanWriter(plan_fh)
+            for post in reversed(posts):  # Post older ones first
+                post.print(site, args.syndicate)
+                plan.write(post, args.syndicate)
+    finish(site, args, failures)
+
+
+def finish(site, args, failures=()):
+    """
+    Logs the end of run summaries, exiting with an error if any post
+    failed.
+    """
+    report_failures(site, [(post.ig_post.code, e) for post, e in failures])
+    if site.ig_limiter is not None:
+        log.info("Instagram %s", site.ig_limiter.summary())
+    if args.metrics:
+        metrics.dump(args.metrics)
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -222,18 +753,50 @@ if __name__ == "__main__":
     to a destination defined in the configuration file.
 
     Usage:
-        python file.py config.json input.har --from=2023/01/01 --to=2023/12/31 [--commit] [--syndicate]
+        python file.py config.json input.har [more.har ...] --from=2023/01/01 --to=2023/12/31 [--commit] [--syndicate]
+        python file.py config.json --apply plan.ndjson
 
     Arguments:
         config_file (str): Path to a JSON configuration file containing 
                            credentials or mapping logic.
-        har_file (str):    Path to the .har file to be processed.
+        har_files (str):   Paths to the .har files to be processed, or
+                           directories and glob patterns matching them.
+                           Optional with --index, ignored with --apply.
 
     Flags:
         --from:   The start date (inclusive) in YYYY/MM/DD format.
         --to:     The end date (inclusive) in YYYY/MM/DD format.
         --commit: Optional flag. If present, changes will be written to the 
-                  destination. Defaults to False (Dry Run mode).
+                  destination. Defaults to False (Dry Run mode), which
+                  writes the plan of what would be posted, one JSON post per
+                  line, oldest first.
+        --plan:   Where to write the plan of a dry run. Defaults to stdout.
+        --apply:  Publish the posts of a plan in its order instead of reading
+                  .har files, "-" for stdin. --from and --to aren't needed.
+        --stream: Optional flag. Read the HAR entries one at a time instead
+                  of loading the whole archive in memory.
+        --prune:  Optional flag. Only look for posts in the known timeline
+                  connections instead of walking every response body.
+        --jobs:   Processes reading the .har files in parallel, one file per
+                  process. Defaults to the number of CPUs.
+        --index:  Optional sqlite3 file where every post found in the .har
+                  files is kept by date. Files already indexed are not read
+                  again, and without .har files only the index is queried.
+        --media-workers: How many carousel pictures are transferred
+                  concurrently. Defaults to 4.
+        --publish-window: How many posts have their media uploaded ahead,
+                  the entries are still created oldest first. Defaults to 4.
+        --ledger: Optional sqlite3 file recording the published posts, those
+                  are skipped on later runs.
+        --media-cache: Optional directory caching the transferred media, so
+                  the same picture is only uploaded once.
+        --ig-rate: Initial requests per second to each Instagram host, 0
+                  disables the rate limiting. Defaults to 2.
+        --config-snapshot: Optional JSON file keeping the discovered
+                  Micropub config between runs.
+        --metrics: Optional json or prometheus. Times each stage and prints
+                  a summary to stderr at the end.
+        -v, --verbose: Debug logging.
 
     Workflow:
         1. Validates file existence and date logic.
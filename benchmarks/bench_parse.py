@@ -0,0 +1,44 @@
+"""
+Times IGPost.parse against the detail and embed pages saved in fixtures/.
+
+    $ python benchmarks/bench_parse.py [--number 200]
+"""
+import os
+import sys
+import timeit
+import argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, "fixtures")
+sys.path.insert(0, os.path.dirname(HERE))
+
+from ugram import IGPost  # noqa: E402
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as fh:
+        return fh.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark IGPost.parse")
+    parser.add_argument('--number', type=int, default=200,
+                        help="Parses per timing run")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    detail_html = read_fixture("detail.html")
+    embed_html = read_fixture("embed.html")
+    result = IGPost.parse(detail_html, embed_html)
+
+    timer = timeit.Timer(lambda: IGPost.parse(detail_html, embed_html))
+    best = min(timer.repeat(repeat=args.repeat, number=args.number))
+    per_post = best / args.number
+    size = len(detail_html) + len(embed_html)
+    print(f"IGPost.parse: {per_post * 1000:.3f} ms/post, "
+          f"{size / 1024 / 1024 / per_post:.1f} MB/s of HTML, "
+          f"{len(result.get('carousel_urls', []))} carousel URLs")
+
+
+if __name__ == "__main__":
+    main()
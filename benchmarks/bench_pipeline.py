@@ -0,0 +1,209 @@
+"""
+Times each stage of the HAR -> post pipeline over synthetic archives of
+several sizes, reporting wall time and peak traced memory per stage.
+
+    $ python benchmarks/bench_pipeline.py --sizes 1000 10000 100000 --output new.json
+    $ python benchmarks/bench_pipeline.py --sizes 1000 10000 --compare old.json
+
+Time and memory are measured on separate runs, tracemalloc slows down the
+code it traces.
+"""
+import gc
+import io
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from datetime import date
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import synth  # noqa: E402
+from bench_parse import read_fixture  # noqa: E402
+from ugram import IGPost, MultipartBody, encode_multipart_formdata  # noqa: E402
+from HARness import (  # noqa: E402
+    HARReader, extract_nodes_from_json, process_har_file, process_nodes,
+    stream_har_file)
+
+FIRST_DAY = date(2000, 1, 1)
+LAST_DAY = date(2100, 1, 1)
+PARSE_POSTS = 200
+UPLOAD_BYTES = 2 * 1024 * 1024
+UPLOADS = 20
+
+
+def measure(func, *args):
+    """
+    :return: (seconds, peak traced bytes, result of the timed run)
+    """
+    gc.collect()
+    started = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - started
+    del result
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def load_har(path):
+    with open(path, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def count_streamed(path):
+    return sum(1 for _ in stream_har_file(HARReader(path)))
+
+
+def filter_nodes(found, first_day, last_day):
+    return sum(1 for _ in process_nodes(found, first_day, last_day))
+
+
+def decode_bodies(har_data):
+    bodies = []
+    for entry in har_data["log"]["entries"]:
+        content = entry["response"]["content"]
+        text = content["text"]
+        if content.get("encoding") == "base64":
+            text = base64.b64decode(text)
+        bodies.append(json.loads(text))
+    return bodies
+
+
+def extract_all(bodies):
+    return sum(1 for body in bodies for _ in extract_nodes_from_json(body))
+
+
+def parse_fixtures(detail_html, embed_html):
+    for _ in range(PARSE_POSTS):
+        IGPost.parse(detail_html, embed_html)
+    return PARSE_POSTS
+
+
+def encode_buffered(picture):
+    for _ in range(UPLOADS):
+        encode_multipart_formdata(io.BytesIO(picture), "picture.jpg")
+    return UPLOADS
+
+
+def encode_streamed(picture):
+    for _ in range(UPLOADS):
+        for _ in MultipartBody(io.BytesIO(picture), "picture.jpg"):
+            pass
+    return UPLOADS
+
+
+def bench_size(nodes, options, workdir):
+    path = os.path.join(workdir, "synth_{}.har".format(nodes))
+    har_bytes = synth.write_har(path, nodes, **options)
+
+    results = []
+
+    def record(stage, func, *args):
+        seconds, peak, result = measure(func, *args)
+        results.append({"stage": stage, "nodes": nodes, "seconds": seconds,
+                        "peak_bytes": peak, "har_bytes": har_bytes})
+        return result
+
+    har_data = record("json.load", load_har, path)
+    found = record("process_har_file", process_har_file, har_data)
+    record("stream_har_file", count_streamed, path)
+    bodies = decode_bodies(har_data)
+    del har_data
+    record("extract_nodes_from_json", extract_all, bodies)
+    del bodies
+    record("process_nodes", filter_nodes, found, FIRST_DAY, LAST_DAY)
+    os.unlink(path)
+    return results
+
+
+def bench_per_post():
+    detail_html, embed_html = read_fixture("detail.html"), read_fixture("embed.html")
+    picture = os.urandom(UPLOAD_BYTES)
+    results = []
+    for stage, count, func, args in [
+            ("IGPost.parse", PARSE_POSTS, parse_fixtures, (detail_html, embed_html)),
+            ("encode_multipart_formdata", UPLOADS, encode_buffered, (picture,)),
+            ("MultipartBody", UPLOADS, encode_streamed, (picture,))]:
+        seconds, peak, _ = measure(func, *args)
+        results.append({"stage": stage, "nodes": None, "seconds": seconds / count,
+                        "peak_bytes": peak, "har_bytes": None})
+    return results
+
+
+def print_results(results, baseline=None):
+    previous = {}
+    for row in baseline or []:
+        previous[(row["stage"], row["nodes"])] = row
+
+    print("{:<28}{:>9}{:>12}{:>12}{:>12}".format(
+        "stage", "nodes", "ms", "peak MB", "MB/s"))
+    for row in results:
+        line = "{:<28}{:>9}{:>12.2f}{:>12.2f}".format(
+            row["stage"], row["nodes"] or "per post", row["seconds"] * 1000,
+            row["peak_bytes"] / 1024 / 1024)
+        if row["har_bytes"]:
+            line += "{:>12.1f}".format(
+                row["har_bytes"] / 1024 / 1024 / row["seconds"])
+        else:
+            line += "{:>12}".format("")
+        old = previous.get((row["stage"], row["nodes"]))
+        if old:
+            line += "  time x{:.2f} mem x{:.2f}".format(
+                row["seconds"] / old["seconds"],
+                row["peak_bytes"] / max(old["peak_bytes"], 1))
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the HAR -> post pipeline stages")
+    parser.add_argument('--sizes', type=int, nargs="+",
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--carousel', type=int, default=3)
+    parser.add_argument('--nesting', type=int, default=3)
+    parser.add_argument('--base64', type=float, default=0.25)
+    parser.add_argument('--output', help="Write the results as JSON here")
+    parser.add_argument('--compare', help="JSON results of a previous run")
+    args = parser.parse_args()
+
+    options = {"carousel": args.carousel, "nesting": args.nesting,
+               "base64_share": args.base64}
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for nodes in args.sizes:
+            results.extend(bench_size(nodes, options, workdir))
+    results.extend(bench_per_post())
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fh:
+            baseline = json.load(fh)["results"]
+    print_results(results, baseline)
+
+    if args.output:
+        report = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "options": options,
+            "results": results,
+        }
+        with open(args.output, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
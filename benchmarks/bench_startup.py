@@ -0,0 +1,119 @@
+"""
+Measures the cold start of ugram.py: the time to import the modules in a
+fresh interpreter, and a whole one post run against the stand-in server
+of mp_server.py, discovering the Micropub config and with a
+--config-snapshot of it.
+
+    $ python benchmarks/bench_startup.py --runs 10 --latency 100
+
+Every run is a new process, as a Lambda cold start or a cron job would be.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+UGRAM = os.path.join(ROOT, "ugram.py")
+sys.path.insert(0, HERE)
+
+from mp_server import StandInServer  # noqa: E402
+
+
+def run(command, runs):
+    """
+    :return: Median wall time in ms of running `command` `runs` times
+    """
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def bench_imports(runs):
+    results = [("python -c pass", run([sys.executable, "-c", "pass"], runs))]
+    for module in ("ugram", "HARness"):
+        command = [sys.executable, "-c", "import {}".format(module)]
+        results.append(("import " + module, run(command, runs)))
+    return results
+
+
+def write_plan(path, server):
+    entry = {
+        "code": "STARTUP", "text": "Cold start", "video_url": None,
+        "picture_urls": [server.base_url + "/images/startup.jpg"],
+        "publish_date": None, "syndicate": False,
+    }
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write(json.dumps(entry) + "\n")
+
+
+def bench_post(server, runs, workdir):
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w", encoding="utf-8") as fh:
+        json.dump({"user": "startup", "endpoint": server.endpoint,
+                   "token": server.token}, fh)
+    plan_path = os.path.join(workdir, "plan.ndjson")
+    write_plan(plan_path, server)
+    snapshot = os.path.join(workdir, "mp_config.json")
+    command = [sys.executable, UGRAM, config_path, "--apply", plan_path,
+               "--ig-rate", "0"]
+
+    def config_requests():
+        return server.stats.summary().get("config", {}).get("count", 0)
+
+    results = []
+    before = config_requests()
+    results.append(("post, discovering config", run(command, runs),
+                    (config_requests() - before) / runs))
+
+    # The first run writes the snapshot the measured ones start from
+    run(command + ["--config-snapshot", snapshot], 1)
+    before = config_requests()
+    results.append(("post, config snapshot",
+                    run(command + ["--config-snapshot", snapshot], runs),
+                    (config_requests() - before) / runs))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ugram.py start up")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=100,
+                        help="Milliseconds added by the server to every request")
+    parser.add_argument('--output', help="Write the results as JSON here")
+    args = parser.parse_args()
+
+    results = []
+    print("{:<32}{:>10}".format("stage", "ms"))
+    for stage, ms in bench_imports(args.runs):
+        print("{:<32}{:>10.1f}".format(stage, ms))
+        results.append({"stage": stage, "ms": ms})
+
+    server = StandInServer(latency=args.latency / 1000).start()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            post_results = bench_post(server, args.runs, workdir)
+    finally:
+        server.stop()
+    print("\n{:<32}{:>10}{:>18}".format("run", "ms", "config requests"))
+    for stage, ms, config_requests in post_results:
+        print("{:<32}{:>10.1f}{:>18.1f}".format(stage, ms, config_requests))
+        results.append({"stage": stage, "ms": ms,
+                        "config_requests": config_requests})
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Runs HARness.py end to end against the local stand-in server of
+mp_server.py, over a synthetic archive, and reports the posts per second,
+p50/p99 latency per request type and the bytes transferred.
+
+    $ python benchmarks/loadtest.py --posts 200 --carousel 3 --latency 20
+
+Arguments it doesn't know are passed to HARness.py, as --media-workers 8.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HARNESS = os.path.join(os.path.dirname(HERE), "HARness.py")
+sys.path.insert(0, HERE)
+
+import synth  # noqa: E402
+from mp_server import StandInServer  # noqa: E402
+
+
+def run_harness(server, posts, options, harness_args, workdir, verbose):
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w", encoding="utf-8") as fh:
+        json.dump({"user": "loadtest", "endpoint": server.endpoint,
+                   "token": server.token}, fh)
+    har_path = os.path.join(workdir, "loadtest.har")
+    synth.write_har(har_path, posts,
+                    cdn_url=server.base_url + "/images/{}.jpg", **options)
+
+    command = [sys.executable, HARNESS, config_path, har_path,
+               "--from=2000/01/01", "--to=2100/01/01", "--commit"]
+    command.extend(harness_args)
+    output = None if verbose else subprocess.PIPE
+    started = time.perf_counter()
+    process = subprocess.run(command, stdout=output, stderr=output)
+    elapsed = time.perf_counter() - started
+    if process.returncode:
+        if process.stderr:
+            sys.stderr.write(process.stderr.decode("utf-8", "replace")[-4000:])
+        print("HARness.py exited with {}".format(process.returncode))
+    return elapsed
+
+
+def report(stats, elapsed):
+    entries = stats.get("entry", {})
+    posts = entries.get("count", 0) - entries.get("errors", 0)
+    print("{} posts in {:.2f}s: {:.2f} posts/s".format(
+        posts, elapsed, posts / elapsed))
+    print("{:<8}{:>8}{:>8}{:>10}{:>10}{:>12}{:>12}".format(
+        "type", "count", "errors", "p50 ms", "p99 ms", "MB in", "MB out"))
+    for kind in ("config", "image", "media", "entry"):
+        row = stats.get(kind)
+        if not row:
+            continue
+        print("{:<8}{:>8}{:>8}{:>10.1f}{:>10.1f}{:>12.2f}{:>12.2f}".format(
+            kind, row["count"], row["errors"], row["p50_ms"], row["p99_ms"],
+            row["bytes_in"] / 1024 / 1024, row["bytes_out"] / 1024 / 1024))
+    return {"posts": posts, "seconds": elapsed,
+            "posts_per_second": posts / elapsed, "requests": stats}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="End to end load test of HARness.py")
+    parser.add_argument('--posts', type=int, default=100)
+    parser.add_argument('--carousel', type=int, default=3)
+    parser.add_argument('--base64', type=float, default=0.0)
+    parser.add_argument('--picture-kb', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Milliseconds added by the server to every request")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="Share of POSTs that fail with a 500")
+    parser.add_argument('--output', help="Write the results as JSON here")
+    parser.add_argument('--verbose', action="store_true")
+    args, harness_args = parser.parse_known_args()
+
+    server = StandInServer(latency=args.latency / 1000,
+                           error_rate=args.error_rate,
+                           picture_bytes=args.picture_kb * 1024).start()
+    options = {"carousel": args.carousel, "nesting": 1,
+               "base64_share": args.base64, "video_share": 0}
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            elapsed = run_harness(server, args.posts, options, harness_args,
+                                  workdir, args.verbose)
+        results = report(server.stats.summary(), elapsed)
+    finally:
+        server.stop()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
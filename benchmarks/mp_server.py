@@ -0,0 +1,279 @@
+"""
+Local stand-in for a Micropub endpoint, its media endpoint, the
+Instagram CDN and profile page, to measure ugram.py and HARness.py without
+touching a real site.
+
+    $ python benchmarks/mp_server.py --port 8080 --latency 20 --error-rate 0.01
+
+- GET  /micropub?q=config  answers with the media endpoint
+- POST /micropub           creates an entry, 201 + Location
+- POST /media              accepts a multipart upload, 201 + Location
+- GET  /images/<name>      serves deterministic picture bytes
+- GET  /profile/<user>/    profile page with the newest posts, for the
+                           `ugram.py --watch` mode
+- POST /profile            adds a new post to the profile, answers its code
+- GET  /stats              per request type counts, latencies and bytes
+
+Latency is injected on every request and errors (500) on the POSTs.
+"""
+import json
+import time
+import hashlib
+import random
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PICTURE_BYTES = 200 * 1024
+# Posts shown in the profile page, as Instagram does
+PROFILE_POSTS = 12
+PROFILE_HTML = """<!DOCTYPE html>
+<html><head><title>{user} on Instagram</title></head><body>
+<script type="text/javascript">window._sharedData = {payload};</script>
+</body></html>"""
+
+
+def percentile(values, share):
+    """
+    Nearest-rank percentile, `share` between 0 and 1.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(share * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Stats:
+    """
+    Per request type counters, shared by the handler threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+
+    def record(self, kind, status, seconds, bytes_in, bytes_out):
+        with self._lock:
+            entry = self._types.setdefault(kind, {
+                "count": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0,
+                "latencies": []})
+            entry["count"] += 1
+            entry["errors"] += status >= 400
+            entry["bytes_in"] += bytes_in
+            entry["bytes_out"] += bytes_out
+            entry["latencies"].append(seconds)
+
+    def summary(self):
+        with self._lock:
+            types = {kind: dict(entry, latencies=list(entry["latencies"]))
+                     for kind, entry in self._types.items()}
+        result = {}
+        for kind, entry in types.items():
+            latencies = entry.pop("latencies")
+            entry["p50_ms"] = percentile(latencies, 0.50) * 1000
+            entry["p99_ms"] = percentile(latencies, 0.99) * 1000
+            result[kind] = entry
+        return result
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/micropub" and parse_qs(url.query).get("q") == ["config"]:
+            config = {"media-endpoint": self.server.base_url + "/media",
+                      "syndicate-to": [{"uid": "twitter", "name": "Twitter"},
+                                       {"uid": "mastodon", "name": "Mastodon"}]}
+            return self.respond("config", 200, json.dumps(config).encode("utf-8"),
+                                "application/json")
+        if url.path.startswith("/images/"):
+            return self.respond("image", 200, self.server.picture(url.path),
+                                "image/jpeg")
+        if url.path.startswith("/profile/"):
+            user = url.path.strip("/").split("/")[-1]
+            return self.respond("profile", 200, self.server.profile_page(user),
+                                "text/html; charset=utf-8")
+        if url.path == "/stats":
+            body = json.dumps(self.server.stats.summary()).encode("utf-8")
+            return self.send(200, body, "application/json")
+        return self.send(404)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path == "/media":
+            kind, prefix = "media", "/uploads/"
+        elif url.path == "/micropub":
+            kind, prefix = "entry", "/entries/"
+        elif url.path == "/profile":
+            self.read_body()
+            code = self.server.add_profile_post()
+            return self.respond("new_post", 201, code.encode("utf-8"),
+                                "text/plain")
+        else:
+            # Drained so the connection can be kept alive
+            self.read_body()
+            return self.send(404)
+
+        received = self.read_body()
+        if self.headers.get("Authorization", "").split(" ")[-1] != self.server.token:
+            return self.respond(kind, 401, received=received)
+        if random.random() < self.server.error_rate:
+            return self.respond(kind, 500, received=received)
+        location = self.server.base_url + prefix + str(self.server.next_id())
+        return self.respond(kind, 201, received=received,
+                            headers={"Location": location})
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        remaining = length
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+        return length - remaining
+
+    def respond(self, kind, status, body=b"", content_type=None, received=0,
+                headers=None):
+        started = time.perf_counter()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send(status, body, content_type, headers)
+        self.server.stats.record(kind, status, time.perf_counter() - started,
+                                 received, len(body))
+
+    def send(self, status, body=b"", content_type=None, headers=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    :param latency: Seconds added to every request
+    :param error_rate: Share of POSTs answered with a 500
+    """
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, token="token", latency=0.0,
+                 error_rate=0.0, picture_bytes=PICTURE_BYTES, verbose=False):
+        super().__init__((host, port), Handler)
+        self.token = token
+        self.latency = latency
+        self.error_rate = error_rate
+        self.picture_bytes = picture_bytes
+        self.verbose = verbose
+        self.stats = Stats()
+        self.profile_posts = []
+        self._ids = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    @property
+    def endpoint(self):
+        return self.base_url + "/micropub"
+
+    def next_id(self):
+        with self._lock:
+            self._ids += 1
+            return self._ids
+
+    def picture(self, path):
+        # Same bytes for the same path, different between paths
+        seed = hashlib.sha256(path.encode("utf-8")).digest()
+        body = seed * (self.picture_bytes // len(seed) + 1)
+        return b"\xff\xd8\xff\xe0" + body[:self.picture_bytes]
+
+    def add_profile_post(self, carousel=2, taken_at=None):
+        """
+        Publishes a new post on the stand-in profile, with `carousel`
+        pictures, 1 for a single picture.
+
+        :return: Its shortcode
+        """
+        with self._lock:
+            index = len(self.profile_posts)
+            code = "W{:010d}".format(index)
+            pictures = [self.base_url + "/images/{}_{}.jpg".format(code, n)
+                        for n in range(carousel)]
+            node = {
+                "__typename": "GraphSidecar" if carousel > 1 else "GraphImage",
+                "shortcode": code,
+                "taken_at_timestamp": taken_at or int(time.time()) + index,
+                "display_url": pictures[0],
+                "is_video": False,
+                "edge_media_to_caption": {"edges": [
+                    {"node": {"text": "Stand-in post {}".format(index)}}]},
+            }
+            if carousel > 1:
+                node["edge_sidecar_to_children"] = {"edges": [
+                    {"node": {"display_url": url}} for url in pictures]}
+            self.profile_posts.append(node)
+        return code
+
+    def profile_page(self, user):
+        with self._lock:
+            newest = self.profile_posts[::-1][:PROFILE_POSTS]
+        payload = {"entry_data": {"ProfilePage": [{"graphql": {"user": {
+            "username": user,
+            "edge_owner_to_timeline_media": {
+                "count": len(newest),
+                "edges": [{"node": node} for node in newest],
+            },
+        }}}]}}
+        # </ can't be in a <script>, as in the real page
+        payload = json.dumps(payload).replace("</", "<\\/")
+        return PROFILE_HTML.format(user=escape(user),
+                                   payload=payload).encode("utf-8")
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Micropub stand-in")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--token', default="token")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Milliseconds added to every request")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="Share of POSTs that fail with a 500")
+    parser.add_argument('--verbose', action="store_true")
+    args = parser.parse_args()
+    server = StandInServer(args.host, args.port, args.token,
+                           args.latency / 1000, args.error_rate,
+                           verbose=args.verbose)
+    print("Micropub endpoint: {}".format(server.endpoint))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Generates synthetic .har files shaped like the Instagram profile timeline
+queries that HARness.py processes.
+
+    $ python benchmarks/synth.py out.har --nodes 10000 --carousel 4 --base64 0.25
+"""
+import json
+import base64
+import random
+import argparse
+
+CONNECTION = "xdt_api__v1__feed__user_timeline_graphql_connection"
+CDN_URL = "https://scontent.cdninstagram.com/v/t51.29350-15/{}_n.jpg?stp=dst-jpg_e35&_nc_ht=scontent.cdninstagram.com"
+START_TIMESTAMP = 1577836800  # 2020-01-01
+NODES_PER_ENTRY = 12
+
+
+def image_versions(name, cdn_url=CDN_URL):
+    return {"candidates": [
+        {"url": cdn_url.format("{}_{}".format(name, width)),
+         "width": width, "height": width}
+        for width in (1080, 750, 640, 480, 320)
+    ]}
+
+
+def noise(depth, rng):
+    """
+    Nested user/friendship style data found around the posts, that the
+    node extractor has to walk through.
+    """
+    tree = {"id": str(rng.randrange(10 ** 15)), "is_verified": False}
+    for level in range(depth):
+        tree = {"level_{}".format(level): tree,
+                "items": [{"pk": rng.randrange(10 ** 9)}, None, True]}
+    return tree
+
+
+def make_node(index, carousel, video_share, nesting, rng, cdn_url=CDN_URL):
+    code = "C{:010d}".format(index)
+    node = {
+        "code": code,
+        "pk": str(rng.randrange(10 ** 18)),
+        "media_type": 1,
+        "caption": {
+            "created_at": START_TIMESTAMP + index * 3600,
+            "text": "Synthetic post {} #{}".format(index, rng.choice(["sunset", "food", "travel"])),
+        },
+        "image_versions2": image_versions(code, cdn_url),
+        "video_versions": None,
+        "carousel_media": None,
+        "user": noise(nesting, rng),
+    }
+    if rng.random() < video_share:
+        node["media_type"] = 2
+        node["video_versions"] = [{"url": cdn_url.format(code).replace(".jpg", ".mp4"), "type": 101}]
+    elif carousel > 1:
+        node["media_type"] = 8
+        node["carousel_media"] = [
+            {"image_versions2": image_versions("{}_{}".format(code, item), cdn_url)}
+            for item in range(carousel)
+        ]
+    return node
+
+
+def make_entry(nodes, base64_share, rng):
+    body = json.dumps({
+        "data": {CONNECTION: {
+            "edges": [{"node": node, "cursor": node["pk"]} for node in nodes],
+            "page_info": {"has_next_page": True, "end_cursor": nodes[-1]["pk"]},
+        }},
+        "extensions": {"is_final": True},
+        "status": "ok",
+    })
+    content = {"size": len(body), "mimeType": "application/json; charset=utf-8",
+               "text": body}
+    if rng.random() < base64_share:
+        content["text"] = base64.b64encode(body.encode("utf-8")).decode("ascii")
+        content["encoding"] = "base64"
+        content["mimeType"] = "text/javascript; charset=utf-8"
+    return {
+        "startedDateTime": "2024-01-01T00:00:00.000Z",
+        "time": 120.5,
+        "request": {"method": "POST", "url": "https://www.instagram.com/graphql/query",
+                    "headers": [], "queryString": [], "bodySize": 0},
+        "response": {"status": 200, "statusText": "", "headers": [],
+                     "content": content, "bodySize": len(body)},
+        "timings": {"send": 0, "wait": 100, "receive": 20},
+    }
+
+
+def iter_entries(nodes, carousel=3, nesting=3, base64_share=0.0,
+                 video_share=0.1, seed=0, cdn_url=CDN_URL):
+    """
+    :param cdn_url: Template for the picture URLs, formatted with a name
+    """
+    rng = random.Random(seed)
+    for start in range(0, nodes, NODES_PER_ENTRY):
+        page = [make_node(index, carousel, video_share, nesting, rng, cdn_url)
+                for index in range(start, min(nodes, start + NODES_PER_ENTRY))]
+        yield make_entry(page, base64_share, rng)
+
+
+def write_har(path, nodes, **options):
+    """
+    Writes the archive one entry at a time, so that large ones don't need
+    to fit in memory.
+
+    :return: Size in bytes of the written file
+    """
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write('{"log": {"version": "1.2", "creator": {"name": "synth", "version": "1"}, '
+                 '"pages": [], "entries": [\n')
+        for index, entry in enumerate(iter_entries(nodes, **options)):
+            if index:
+                fh.write(",\n")
+            fh.write(json.dumps(entry))
+        fh.write("\n]}}\n")
+        return fh.tell()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic .har file")
+    parser.add_argument('output')
+    parser.add_argument('--nodes', type=int, default=1000)
+    parser.add_argument('--carousel', type=int, default=3,
+                        help="Pictures per carousel post, 1 for single pictures")
+    parser.add_argument('--nesting', type=int, default=3,
+                        help="Depth of the unrelated data around each node")
+    parser.add_argument('--base64', type=float, default=0.0,
+                        help="Share of base64 encoded response bodies")
+    parser.add_argument('--video', type=float, default=0.1,
+                        help="Share of video posts")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    size = write_har(args.output, args.nodes, carousel=args.carousel,
+                     nesting=args.nesting, base64_share=args.base64,
+                     video_share=args.video, seed=args.seed)
+    print("Wrote {} nodes, {:.1f} MB".format(args.nodes, size / 1024 / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,28 @@
+import os
 import re
+import sys
+import ssl
 import json
+import select
+import random
 import argparse
+import threading
 import logging as log
+from io import SEEK_END, BytesIO
+from time import monotonic, perf_counter, sleep, time
+from collections import deque
+from contextlib import nullcontext
 from html import unescape
-from os.path import basename
-from datetime import datetime
-from urllib.request import urlopen, Request
-from urllib.parse import urlencode, urlparse, urljoin
+from shutil import copyfileobj
+from os.path import basename, join
+from tempfile import SpooledTemporaryFile, TemporaryFile, mkstemp
+from datetime import datetime, timezone
+from urllib.error import HTTPError
+from urllib.request import getproxies, proxy_bypass, urlopen, Request
+from urllib.parse import unquote, urlencode, urlparse, urljoin, urlsplit
+from http.client import HTTPConnection, HTTPSConnection, IncompleteRead
+# asyncio, concurrent.futures, sqlite3, hashlib, mimetypes and email.utils are
+# imported where they are used, one-shot runs don't pay for what they skip.
 
 
 PROFILE_URL = "https://www.instagram.com/{}"
@@ -14,8 +30,127 @@ DETAIL_URL = "https://www.instagram.com/p/{}/"
 EMBED_URL = "https://www.instagram.com/p/{}/embed/"
 UA = "Mozilla/5.0 (X11; Linux x86_64; rv:71.0) Gecko/20100101 Firefox/71.0"
 REQ_HEADERS = {"User-Agent": UA}
+# Bytes held in memory at a time when streaming a file
+CHUNK_SIZE = 64 * 1024
+# How many carousel pictures are downloaded/uploaded at the same time
+MEDIA_WORKERS = 4
+# Posts whose media is uploaded ahead of the entry being published
+PUBLISH_WINDOW = 4
+# Keep-alive connection pool settings
+HTTP_TIMEOUT = 60
+IDLE_TIMEOUT = 30
+MAX_IDLE = MEDIA_WORKERS
+REDIRECT_CODES = {301, 302, 303, 307, 308}
+# Adaptive rate limit for the Instagram hosts, in requests per second. The
+# rate grows by IG_RATE_STEP on each success and is halved on each 429.
+IG_RATE = 2.0
+IG_MIN_RATE = 0.05
+IG_MAX_RATE = 20.0
+IG_RATE_STEP = 0.1
+IG_RETRIES = 5
+RETRY_CODES = {429, 500, 502, 503, 504}
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+# Retries of the requests to the Micropub and media endpoints
+MP_RETRIES = 3
+# Patterns to scrape the Instagram detail and embed pages
+OG_TITLE_RE = re.compile(r'"og:title"\s+content="([^"]*)"')
+SRC_RE = re.compile(r'src=.([^"]*)')
+HANDLE_RE = re.compile(r's\.handle\((.*?)\);requireLazy')
+SHARED_DATA_RE = re.compile(r'window\._sharedData\s*=\s*')
+# Bytes of downloaded media kept on disk by the media cache
+MEDIA_CACHE_BYTES = 1024 * 1024 * 1024
+# Instagram pages are served from the page cache for PAGE_CACHE_TTL seconds,
+# then revalidated. At most PAGE_CACHE_BYTES of them are kept.
+PAGE_CACHE_TTL = 24 * 3600
+PAGE_CACHE_BYTES = 64 * 1024 * 1024
 
-log.basicConfig(level=log.DEBUG)
+
+class Metrics:
+    """
+    Timers and counters around each stage of a run. Disabled by default, in
+    which case `timer` returns a shared no-op context manager and `count`
+    returns right away, so the instrumentation is almost free.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.timers = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def timer(self, stage):
+        """
+        Context manager adding the time spent in the block to `stage`.
+        """
+        if not self.enabled:
+            return NO_TIMER
+        return _Timer(self, stage)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, stage, seconds):
+        with self._lock:
+            calls, total, slowest = self.timers.get(stage, (0, 0.0, 0.0))
+            self.timers[stage] = (calls + 1, total + seconds, max(slowest, seconds))
+
+    def merge(self, timers, counters):
+        """
+        Adds the timers and counters gathered by another process.
+        """
+        with self._lock:
+            for stage, (calls, total, slowest) in timers.items():
+                own = self.timers.get(stage, (0, 0.0, 0.0))
+                self.timers[stage] = (own[0] + calls, own[1] + total,
+                                      max(own[2], slowest))
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_json(self):
+        stages = {stage: {"count": calls, "seconds": total, "max_seconds": slowest}
+                  for stage, (calls, total, slowest) in sorted(self.timers.items())}
+        return json.dumps({"stages": stages, "counters": dict(sorted(self.counters.items()))},
+                          indent=2)
+
+    def to_prometheus(self):
+        lines = ["# TYPE ugram_stage_seconds summary"]
+        for stage, (calls, total, _) in sorted(self.timers.items()):
+            lines.append('ugram_stage_seconds_count{{stage="{}"}} {}'.format(stage, calls))
+            lines.append('ugram_stage_seconds_sum{{stage="{}"}} {:.6f}'.format(stage, total))
+        for name, value in sorted(self.counters.items()):
+            lines.append("# TYPE ugram_{}_total counter".format(name))
+            lines.append("ugram_{}_total {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, format, fh=None):
+        """
+        :param format: "json" or "prometheus"
+        :param fh: Where to write the summary, stderr by default
+        """
+        text = self.to_prometheus() if format == "prometheus" else self.to_json() + "\n"
+        (fh or sys.stderr).write(text)
+
+
+class _Timer:
+    __slots__ = ("metrics", "stage", "started")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.stage, perf_counter() - self.started)
+
+
+NO_TIMER = nullcontext()
+metrics = Metrics()
 
 
 def str2bool(v):
@@ -30,56 +165,630 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected (True/False).')
 
 
+class ConnectionPool:
+    """
+    Keeps idle keep-alive connections per host so that consecutive requests
+    to the Micropub, media and Instagram hosts skip the TCP and TLS
+    handshakes. Safe to share between threads, each request checks out its
+    own connection and returns it once the response has been fully read.
+
+    The proxies from the environment are used as urlopen would, HTTPS
+    requests tunnel through them with CONNECT.
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, max_idle=MAX_IDLE,
+                 timeout=HTTP_TIMEOUT):
+        """
+        :param idle_timeout: Seconds after which an idle connection is
+            dropped instead of reused
+        :param max_idle: Idle connections kept per host
+        :param timeout: Socket timeout for the connections
+        """
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._ssl_context = None
+        self._proxies = getproxies()
+        self._routes = {}
+
+    def urlopen(self, request, max_redirects=5):
+        """
+        Same contract as urllib's `urlopen`: follows redirects for GET
+        requests and raises HTTPError for 4xx and 5xx responses.
+
+        :param request: URL string or urllib `Request`
+        :return: File-like response with `status`, `reason` and `headers`
+        """
+        if isinstance(request, str):
+            request = Request(request)
+        method = request.get_method()
+        url = request.full_url
+        body = request.data
+        headers = dict(request.header_items())
+        if body is not None and "content-type" not in map(str.lower, headers):
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        for _ in range(max_redirects + 1):
+            response = self.request(method, url, body, headers)
+            location = response.headers.get("Location")
+            if (response.status in REDIRECT_CODES and location
+                    and method in ("GET", "HEAD")):
+                response.read()
+                response.close()
+                url = urljoin(url, location)
+                continue
+            break
+
+        if response.status >= 400:
+            fp = BytesIO(response.read())
+            response.close()
+            raise HTTPError(url, response.status, response.reason,
+                            response.headers, fp)
+        return response
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Sends a single request, retrying once on a fresh connection if a
+        reused one turns out to have been closed by the server.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        proxy = self._proxy(key)
+        if proxy is not None and parts.scheme == "http":
+            # Plain HTTP proxies take the whole URL, HTTPS ones a tunnel
+            path = url.split("#")[0]
+            if proxy[2]:
+                headers = dict(headers or {})
+                headers["Proxy-Authorization"] = proxy[2]
+
+        conn, reused = self._checkout(key)
+        try:
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+            except ConnectionError:
+                conn.close()
+                # Only bytes bodies can be sent again, a stream is half
+                # consumed. A POST may have been handled before the
+                # connection dropped.
+                if (not reused or method == "POST"
+                        or not (body is None or isinstance(body, bytes))):
+                    raise
+                log.debug("Stale connection to %s, reconnecting",
+                          parts.hostname)
+                conn = self._connect(key)
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+        except BaseException:
+            # A half written request leaves the connection unusable
+            conn.close()
+            raise
+        return PooledResponse(self, key, conn, response, url)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
+
+    def _checkout(self, key):
+        now = monotonic()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout and not _is_stale(conn):
+                    return conn, True
+                conn.close()
+        return self._connect(key), False
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((conn, monotonic()))
+                return
+        conn.close()
+
+    def _connect(self, key):
+        scheme, host, port = key
+        proxy = self._proxy(key)
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            if proxy is None:
+                return HTTPSConnection(host, port, timeout=self.timeout,
+                                       context=self._ssl_context)
+            proxy_host, proxy_port, authorization = proxy
+            conn = HTTPSConnection(proxy_host, proxy_port,
+                                   timeout=self.timeout,
+                                   context=self._ssl_context)
+            tunnel_headers = None
+            if authorization:
+                tunnel_headers = {"Proxy-Authorization": authorization}
+            conn.set_tunnel(host, port, headers=tunnel_headers)
+            return conn
+        if proxy is not None:
+            host, port = proxy[:2]
+        return HTTPConnection(host, port, timeout=self.timeout)
+
+    def _proxy(self, key):
+        """
+        :return: (host, port, Proxy-Authorization header or None) of the
+            proxy to reach `key` through, None to connect directly.
+        """
+        if key not in self._routes:
+            scheme, host, _ = key
+            proxy = self._proxies.get(scheme)
+            if not proxy or proxy_bypass(host):
+                self._routes[key] = None
+            else:
+                if "://" not in proxy:
+                    proxy = "http://" + proxy
+                parts = urlsplit(proxy)
+                authorization = None
+                if parts.username:
+                    import base64
+                    credentials = "{}:{}".format(unquote(parts.username),
+                                                 unquote(parts.password or ""))
+                    authorization = "Basic " + base64.b64encode(
+                        credentials.encode("utf-8")).decode("ascii")
+                self._routes[key] = (parts.hostname, parts.port or 80,
+                                     authorization)
+        return self._routes[key]
+
+
+def _is_stale(conn):
+    """
+    An idle keep-alive socket that is readable has either been closed by
+    the server or has unexpected data in it, both make it unusable.
+    """
+    if conn.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+class PooledResponse:
+    """
+    Wraps an `http.client.HTTPResponse` and gives its connection back to
+    the pool once the body has been read to the end. Closing it before
+    that drops the connection.
+    """
+
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        if self._conn is None:
+            return
+        if self._response.isclosed():
+            self._release()
+        else:
+            self._response.close()
+            self._conn.close()
+            self._conn = None
+
+    def _release(self):
+        if self._conn is None:
+            return
+        if self._response.will_close:
+            self._conn.close()
+        else:
+            self._pool._checkin(self._key, self._conn)
+        self._conn = None
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _urlopen(request, pool=None):
+    """
+    Goes through the connection pool if there's one, plain urlopen if not.
+    """
+    if pool is None:
+        return urlopen(request)
+    return pool.urlopen(request)
+
+
+class RateLimiter:
+    """
+    Token bucket per host whose rate adapts to what the server tolerates
+    (AIMD): it grows additively with every successful request and is
+    halved on every throttled one, pausing the host for its Retry-After.
+
+    `rates` and `throttle_events` can be inspected to see where a run
+    stands. Safe to share between threads.
+    """
+
+    def __init__(self, rate=IG_RATE, min_rate=IG_MIN_RATE, max_rate=IG_MAX_RATE,
+                 step=IG_RATE_STEP):
+        self.initial_rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.step = step
+        self.rates = {}
+        self.throttle_events = 0
+        self._tokens = {}
+        self._updated = {}
+        self._paused_until = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host):
+        """
+        Blocks until a request to `host` is allowed.
+        """
+        while True:
+            with self._lock:
+                wait = self._take(host, monotonic())
+            if wait <= 0:
+                return
+            sleep(wait)
+
+    def _take(self, host, now):
+        rate = self.rates.setdefault(host, self.initial_rate)
+        paused = self._paused_until.get(host, 0) - now
+        if paused > 0:
+            return paused
+        # Bursts of up to one second worth of requests
+        elapsed = now - self._updated.get(host, now)
+        tokens = min(max(rate, 1.0), self._tokens.get(host, 1.0) + elapsed * rate)
+        self._updated[host] = now
+        if tokens >= 1:
+            self._tokens[host] = tokens - 1
+            return 0
+        self._tokens[host] = tokens
+        return (1 - tokens) / rate
+
+    def on_success(self, host):
+        with self._lock:
+            rate = self.rates.get(host, self.initial_rate)
+            self.rates[host] = min(self.max_rate, rate + self.step)
+
+    def on_throttle(self, host, retry_after=None):
+        with self._lock:
+            rate = self.rates.get(host, self.initial_rate)
+            self.rates[host] = max(self.min_rate, rate / 2)
+            self.throttle_events += 1
+            self._tokens[host] = 0
+            if retry_after:
+                self._paused_until[host] = monotonic() + retry_after
+
+    def summary(self):
+        rates = ", ".join("{} {:.2f} req/s".format(host, rate)
+                          for host, rate in sorted(self.rates.items()))
+        return "Rate: {} - Throttle events: {}".format(
+            rates or "no requests", self.throttle_events)
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """
+    Exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _retry_after(headers):
+    """
+    :return: Seconds to wait from a Retry-After header, None if missing.
+    """
+    value = headers.get("Retry-After") if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def with_retries(call, what, retries=MP_RETRIES,
+                 errors=(ConnectionError, TimeoutError)):
+    """
+    Calls `call` until it succeeds, retrying HTTP errors in RETRY_CODES and
+    `errors` with jittered backoff, or the Retry-After the server asked for.
+
+    :param what: Description of the request for the logs
+    :return: What `call` returned
+    """
+    for attempt in range(retries + 1):
+        try:
+            return call()
+        except HTTPError as e:
+            if e.code not in RETRY_CODES or attempt == retries:
+                raise
+            delay = max(_retry_after(e.headers) or 0, backoff_delay(attempt))
+            reason = e.code
+        except errors as e:
+            if attempt == retries:
+                raise
+            delay = backoff_delay(attempt)
+            reason = e
+        metrics.count("retries")
+        log.warning("%s failed (%s), retrying in %.1fs", what, reason, delay)
+        sleep(delay)
+
+
+def _open_instagram(request, pool=None, limiter=None, retries=IG_RETRIES):
+    """
+    Opens an Instagram URL going through the rate limiter, retrying
+    throttled, failed and dropped requests with jittered backoff.
+    """
+    if isinstance(request, str):
+        request = Request(request, headers=REQ_HEADERS)
+    host = urlsplit(request.full_url).hostname
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire(host)
+        try:
+            response = _urlopen(request, pool)
+        except HTTPError as e:
+            if e.code not in RETRY_CODES or attempt == retries:
+                raise
+            retry_after = _retry_after(e.headers)
+            if limiter is not None and (e.code == 429 or retry_after):
+                limiter.on_throttle(host, retry_after)
+            delay = max(retry_after or 0, backoff_delay(attempt))
+            reason = e.code
+        except (ConnectionError, TimeoutError) as e:
+            if attempt == retries:
+                raise
+            delay = backoff_delay(attempt)
+            reason = e
+        else:
+            if limiter is not None:
+                limiter.on_success(host)
+            return response
+        log.warning("Instagram request failed (%s), retrying in %.1fs: %s",
+                    reason, delay, request.full_url)
+        sleep(delay)
+
+
+def download_resumable(open_url, url, fh, chunk_size=CHUNK_SIZE,
+                       retries=IG_RETRIES):
+    """
+    Downloads `url` into `fh` in `chunk_size` pieces. When the transfer
+    drops it is resumed from the bytes already written with a Range request,
+    servers that ignore the Range get the download started over.
+
+    :param open_url: Callable opening a urllib `Request`, such as
+        `MicroPubSite.open_instagram`
+    :return: Content-Type of the response
+    """
+    written = 0
+    content_type = None
+    for attempt in range(retries + 1):
+        headers = dict(REQ_HEADERS)
+        if written:
+            headers["Range"] = "bytes={}-".format(written)
+        try:
+            with open_url(Request(url, headers=headers)) as response:
+                if written and response.status != 206:
+                    fh.seek(0)
+                    fh.truncate()
+                    written = 0
+                content_type = response.headers.get("Content-Type")
+                expected = response.headers.get("Content-Length")
+                received = 0
+                chunk = response.read(chunk_size)
+                while chunk:
+                    fh.write(chunk)
+                    received += len(chunk)
+                    chunk = response.read(chunk_size)
+                written += received
+                # http.client returns short reads instead of raising when
+                # the connection drops before the Content-Length.
+                if expected is not None and received < int(expected):
+                    raise IncompleteRead(b"", int(expected) - received)
+            return content_type
+        except (ConnectionError, TimeoutError, IncompleteRead) as e:
+            if attempt == retries:
+                raise
+            delay = backoff_delay(attempt)
+            log.warning("Download dropped after %d bytes (%r), resuming in "
+                        "%.1fs: %s", written, e, delay, url)
+            sleep(delay)
+
+
+def video_mime_type(content_type, filename):
+    """
+    :return: The video/* type sent by the server, or guessed from the file
+        name, defaulting to MP4 as used by Instagram.
+    """
+    if content_type and content_type.startswith("video/"):
+        return content_type.split(";")[0].strip()
+    from mimetypes import guess_type
+    guessed, _ = guess_type(filename)
+    if guessed and guessed.startswith("video/"):
+        return guessed
+    return "video/mp4"
+
+
+class MultipartBody:
+    """
+    Streams a multipart/form-data body with a single file under the `file`
+    form field, as needed to upload a file using urllib.urlopen.
+
+    Iterating yields the boundary and headers, then the file in
+    `chunk_size` pieces and finally the trailer, so only one chunk is held
+    in memory at a time. The size of the file must be known up front for
+    the Content-Length, if it can't be found from `fh` it is spooled to a
+    temporary file first.
+    """
+    BOUNDARY = b"________ThIs_Is_tHe_bouNdaRY_$"
+
+    def __init__(self, fh, filename, size=None, mime_type="image/jpeg",
+                 chunk_size=CHUNK_SIZE):
+        if size is None:
+            size = _stream_size(fh)
+        if size is None:
+            fh, size = _spool(fh, chunk_size)
+        self.fh = fh
+        self.size = size
+        self.chunk_size = chunk_size
+
+        filename = filename.encode("utf-8")
+        self.head = b"\r\n".join([
+            b"--" + self.BOUNDARY,
+            b'Content-Disposition: form-data; name="file"; filename= "' + filename + b'"',
+            b"Content-Type: " + mime_type.encode("utf-8"),
+            b"",
+            b"",
+        ])
+        self.tail = b"\r\n--" + self.BOUNDARY + b"--\r\n"
+        self.content_type = "multipart/form-data; boundary={}".format(
+            self.BOUNDARY.decode("utf-8"))
+        self.content_length = len(self.head) + size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        remaining = self.size
+        while remaining > 0:
+            chunk = self.fh.read(min(self.chunk_size, remaining))
+            if not chunk:
+                # The source dropped, a streamed download does not raise
+                raise IncompleteRead(b"", remaining)
+            remaining -= len(chunk)
+            yield chunk
+        yield self.tail
+
+
+def _stream_size(fh):
+    """
+    :return: Bytes left to read from `fh` if they can be known without
+        reading it, None otherwise.
+    """
+    headers = getattr(fh, "headers", None)
+    if headers is not None and headers.get("Content-Length"):
+        return int(headers["Content-Length"])
+    try:
+        if fh.seekable():
+            position = fh.tell()
+            size = fh.seek(0, SEEK_END) - position
+            fh.seek(position)
+            return size
+    except (AttributeError, OSError):
+        pass
+    return None
+
+
+def _spool(fh, chunk_size):
+    """
+    Copies `fh` into a temporary file that stays in memory only while small.
+
+    :return: (spooled file positioned at the start, its size)
+    """
+    spooled = SpooledTemporaryFile(max_size=chunk_size)
+    copyfileobj(fh, spooled, chunk_size)
+    size = spooled.tell()
+    spooled.seek(0)
+    return spooled, size
+
+
 def encode_multipart_formdata(fh, filename):
     """
-    Can't believe I need to spell out this function, but this is needed in order
-    to upload a file using urllib.urlopen. Note that this will perform the
-    upload with a single file under the `file` form field.
+    Buffered version of `MultipartBody`, for callers that need the body as
+    bytes.
 
     :param fh: File-like object
     :param filename: filename of such file
     :return: (content type string, body bytes as needed by urlopen)
     """
-    BOUNDARY = b"________ThIs_Is_tHe_bouNdaRY_$"
-    lines = []
-    value = fh.read()
-    filename = filename.encode("utf-8")
-    lines.append(b"--" + BOUNDARY)
-    lines.append(b'Content-Disposition: form-data; name="file"; filename= "' + filename + b'"')
-    lines.append(b"Content-Type: image/jpeg")
-    lines.append(b"")
-    lines.append(value)
-    lines.append(b"--" + BOUNDARY + b"--")
-    lines.append(b"")
-    body = b"\r\n".join(lines)
-    content_type = "multipart/form-data; boundary={}".format(BOUNDARY.decode("utf-8"))
-    return content_type, body
-
-
-def _upload_media(media_endpoint, media_fh, token, filename):
+    body = MultipartBody(fh, filename)
+    return body.content_type, b"".join(body)
+
+
+def _upload_media(media_endpoint, media_fh, token, filename,
+                  mime_type="image/jpeg", pool=None, retries=MP_RETRIES):
     """
     :param media_endpoint: URL where to POST the upload
     :param media_fh: file-like object to upload
     :param token: Bearer token for the MP media endpoint
     :param filename: Filename of identify the file as to the server
+    :param mime_type: Content-Type of the uploaded file
+    :param pool: ConnectionPool to send the request through
+    :param retries: Failed uploads are sent again from the start of the
+        file, only if `media_fh` can seek back to it
     :return: URL of the uploaded file
     """
     log.debug("Uploading picture to media endpoint")
-    content_type, body = encode_multipart_formdata(media_fh, filename)
-    request = Request(media_endpoint, data=body, headers={
-        "Authorization": "Bearer {}".format(token),
-        "Content-Type": content_type,
-    })
-    response = urlopen(request)
+    try:
+        start = media_fh.tell() if media_fh.seekable() else None
+    except (AttributeError, OSError):
+        start = None
+    if start is None:
+        retries = 0
+
+    def send():
+        if start is not None:
+            media_fh.seek(start)
+        body = MultipartBody(media_fh, filename, mime_type=mime_type)
+        request = Request(media_endpoint, data=body, headers={
+            "Authorization": "Bearer {}".format(token),
+            "Content-Type": body.content_type,
+            "Content-Length": str(body.content_length),
+        })
+        with metrics.timer("media_upload"), _urlopen(request, pool) as response:
+            response.read()
+        metrics.count("media_upload_bytes", body.content_length)
+        return response
+
+    response = with_retries(send, "Upload of " + filename, retries)
     if response.status == 201:
         photo_url = response.headers.get("Location")
-        log.debug("Uploaded: {}".format(photo_url))
+        log.debug("Uploaded: %s", photo_url)
         return photo_url
     else:
-        log.error("Failed to upload media: {}".format(response.reason))
+        log.error("Failed to upload media: %s", response.reason)
         raise ValueError(response.reason)
 
 
+def profile_payload(profile_html):
+    """
+    :param profile_html: HTML of a user's profile page
+    :return: The `window._sharedData` JSON payload of the page, as taken by
+        `extract_pictures`
+    """
+    match = SHARED_DATA_RE.search(profile_html)
+    if match is None:
+        raise ValueError("No profile data found in the page.")
+    payload, _ = json.JSONDecoder().raw_decode(profile_html, match.end())
+    return payload
+
+
 def extract_pictures(payload):
     """
     Use this function to get the list of publications from a users' profile
@@ -92,43 +801,507 @@ def extract_pictures(payload):
     """
     user_payload = payload["entry_data"]["ProfilePage"][0]["graphql"]["user"]
     pictures = user_payload["edge_owner_to_timeline_media"]["edges"]
-    log.debug("Found {} pictures".format(len(pictures)))
+    log.debug("Found %s pictures", len(pictures))
     return [p["node"] for p in pictures]
 
 
+class Ledger:
+    """
+    Local sqlite3 record of the Instagram posts already published, keyed by
+    shortcode, so that re-runs over overlapping ranges can skip them before
+    doing any network I/O.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        import sqlite3
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS published (
+                    code TEXT PRIMARY KEY,
+                    entry_url TEXT,
+                    media_urls TEXT NOT NULL,
+                    published_at TEXT NOT NULL
+                )
+            """)
+            # Media uploaded for posts not published yet
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS media (
+                    code TEXT NOT NULL,
+                    source_url TEXT NOT NULL,
+                    location TEXT NOT NULL,
+                    uploaded_at TEXT NOT NULL,
+                    PRIMARY KEY (code, source_url)
+                )
+            """)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+            """)
+
+    def __contains__(self, code):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM published WHERE code = ?", (code,)).fetchone()
+        return row is not None
+
+    def get(self, code):
+        """
+        :return: (entry URL, list of media URLs) for a published post or
+            None if it hasn't been published.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT entry_url, media_urls FROM published WHERE code = ?",
+                (code,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def record(self, code, entry_url, media_urls):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO published VALUES (?, ?, ?, ?)",
+                (code, entry_url, json.dumps(media_urls),
+                 datetime.now().isoformat()))
+            self._db.execute("DELETE FROM media WHERE code = ?", (code,))
+
+    def uploaded_media(self, code):
+        """
+        :return: {Instagram URL: uploaded URL} of the media of a post that
+            was uploaded by an earlier attempt to publish it.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT source_url, location FROM media WHERE code = ?",
+                (code,)).fetchall()
+        return dict(rows)
+
+    def record_media(self, code, source_url, location):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?)",
+                (code, source_url, location, datetime.now().isoformat()))
+
+    def get_state(self, key):
+        """
+        :return: The JSON value saved under `key`, None if there is none.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_state(self, key, value):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO state VALUES (?, ?)",
+                             (key, json.dumps(value)))
+
+    def close(self):
+        self._db.close()
+
+
+class MediaCache:
+    """
+    On-disk, content addressed cache of the media transferred to the media
+    endpoint. Source URLs map to the sha256 of their bytes, and each hash
+    to the `Location` it was uploaded to, so uploading the same picture
+    again, from another run or carousel, is a lookup.
+
+    The downloaded bytes are kept as well so that a failed upload doesn't
+    need to download them again. They are evicted least recently used
+    first once they take more than `max_bytes`.
+    """
+
+    def __init__(self, directory, max_bytes=MEDIA_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(join(directory, "blobs"), exist_ok=True)
+        self._lock = threading.Lock()
+        import sqlite3
+        self._db = sqlite3.connect(join(directory, "index.sqlite3"),
+                                   check_same_thread=False)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS sources (
+                    url TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL
+                )
+            """)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    stored INTEGER NOT NULL,
+                    location TEXT,
+                    last_used REAL NOT NULL
+                )
+            """)
+
+    def lookup(self, url):
+        """
+        :return: (hash, uploaded location or None) for a known source URL,
+            None if it was never downloaded.
+        """
+        with self._lock, self._db:
+            row = self._db.execute("""
+                SELECT blobs.hash, blobs.location FROM sources
+                JOIN blobs ON blobs.hash = sources.hash
+                WHERE sources.url = ?
+            """, (url,)).fetchone()
+            if row is not None:
+                self._touch(row[0])
+        return row
+
+    def location(self, digest):
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT location FROM blobs WHERE hash = ?",
+                (digest,)).fetchone()
+            if row is not None:
+                self._touch(digest)
+        return row and row[0]
+
+    def set_location(self, digest, location):
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE blobs SET location = ? WHERE hash = ?",
+                (location, digest))
+
+    def store(self, url, fh):
+        """
+        Streams `fh` to disk while hashing it.
+
+        :raise IncompleteRead: If `fh` is a response that ended before its
+            Content-Length, nothing is stored then.
+        :return: sha256 hex digest of the contents
+        """
+        import hashlib
+        sha = hashlib.sha256()
+        headers = getattr(fh, "headers", None)
+        expected = headers.get("Content-Length") if headers is not None else None
+        fd, tmp_path = mkstemp(dir=self.directory, suffix=".part")
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for chunk in iter(lambda: fh.read(CHUNK_SIZE), b""):
+                    sha.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+            # http.client returns short reads instead of raising when the
+            # connection drops before the Content-Length.
+            if expected is not None and size < int(expected):
+                raise IncompleteRead(b"", int(expected) - size)
+            digest = sha.hexdigest()
+            os.replace(tmp_path, self._path(digest))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO blobs VALUES (?, ?, 1, NULL, ?)",
+                (digest, size, time()))
+            self._db.execute(
+                "UPDATE blobs SET stored = 1, last_used = ? WHERE hash = ?",
+                (time(), digest))
+            self._db.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?)", (url, digest))
+            # The caller is about to upload it
+            self._evict(keep=digest)
+        return digest
+
+    def open(self, digest):
+        """
+        :return: Binary file with the cached contents, None if evicted.
+        """
+        try:
+            return open(self._path(digest), "rb")
+        except FileNotFoundError:
+            return None
+
+    def _path(self, digest):
+        return join(self.directory, "blobs", digest)
+
+    def _touch(self, digest):
+        self._db.execute(
+            "UPDATE blobs SET last_used = ? WHERE hash = ?", (time(), digest))
+
+    def _evict(self, keep=None):
+        total, = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM blobs WHERE stored").fetchone()
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute(
+            "SELECT hash, size FROM blobs WHERE stored ORDER BY last_used")
+        for digest, size in rows.fetchall():
+            if total <= self.max_bytes:
+                break
+            if digest == keep:
+                continue
+            try:
+                os.unlink(self._path(digest))
+            except FileNotFoundError:
+                pass
+            self._db.execute(
+                "UPDATE blobs SET stored = 0 WHERE hash = ?", (digest,))
+            total -= size
+
+
+class PageCache:
+    """
+    On-disk HTTP cache of the Instagram pages read by `IGPost.fetch_html`,
+    in a single sqlite3 file.
+
+    Pages younger than `ttl` seconds are served without any request. Older
+    ones are revalidated with If-None-Match/If-Modified-Since so an
+    unchanged page costs a 304 instead of the full download. Pages are
+    evicted least recently used first once they take more than `max_bytes`.
+    """
+
+    def __init__(self, path, ttl=PAGE_CACHE_TTL, max_bytes=PAGE_CACHE_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        import sqlite3
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    url TEXT PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    fetched REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+
+    def get(self, url):
+        """
+        :return: (body, etag, last modified, is fresh) for a cached page,
+            None if it isn't cached.
+        """
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT body, etag, last_modified, fetched FROM pages "
+                "WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE pages SET last_used = ? WHERE url = ?", (time(), url))
+        body, etag, last_modified, fetched = row
+        return body, etag, last_modified, time() - fetched < self.ttl
+
+    def conditional_headers(self, cached):
+        """
+        :param cached: The result of `get`
+        :return: The headers to revalidate the cached page
+        """
+        _, etag, last_modified, _ = cached
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def store(self, url, body, headers):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                (url, body, headers.get("ETag"), headers.get("Last-Modified"),
+                 time(), time()))
+            self._evict()
+
+    def revalidated(self, url):
+        """
+        Marks a cached page as fresh again after a 304.
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE pages SET fetched = ? WHERE url = ?", (time(), url))
+
+    def close(self):
+        self._db.close()
+
+    def _evict(self):
+        total, = self._db.execute(
+            "SELECT COALESCE(SUM(LENGTH(body)), 0) FROM pages").fetchone()
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute(
+            "SELECT url, LENGTH(body) FROM pages ORDER BY last_used")
+        for url, size in rows.fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM pages WHERE url = ?", (url,))
+            total -= size
+
+
+def shortcode(pub_url):
+    """
+    :param pub_url: Instagram post URL, as https://www.instagram.com/p/<code>/
+    :return: The shortcode of the post
+    """
+    return [part for part in urlparse(pub_url).path.split("/") if part][-1]
+
+
 class MicroPubSite:
     """
-    Discovers the Micropub config available from the site.
+    Discovers the Micropub config available from the site. It also owns the
+    connection pool shared by every request of the run.
+
+    The config is discovered the first time it is needed, so dry runs never
+    ask for it. With a `config_snapshot` file, the config saved by a
+    previous run is used straight away and discovered again in the
+    background, or right away if an upload with it fails.
     """
 
-    def __init__(self, endpoint, token):
+    def __init__(self, endpoint, token, media_workers=MEDIA_WORKERS,
+                 ledger=None, media_cache=None, ig_rate=IG_RATE,
+                 page_cache=None, config_snapshot=None):
         self.endpoint = endpoint
         self.token = token
+        self.media_workers = media_workers
+        self.ledger = ledger
+        self.media_cache = media_cache
+        self.page_cache = page_cache
+        self.pool = ConnectionPool()
+        # A rate of 0 disables the Instagram rate limiting
+        self.ig_limiter = RateLimiter(ig_rate) if ig_rate else None
         self.headers = {"Authorization": "Bearer {}".format(self.token)}
-        self.mp_config = self.fetch_mp_config()
+        self.config_snapshot = config_snapshot
+        # Whether the config in use came from the snapshot, unconfirmed yet
+        self.from_snapshot = False
+        self._mp_config = None
+        self._mp_config_lock = threading.Lock()
+
+    @property
+    def mp_config(self):
+        with self._mp_config_lock:
+            if self._mp_config is None:
+                self._mp_config = self._load_snapshot()
+                if self._mp_config is not None:
+                    self.from_snapshot = True
+                    threading.Thread(target=self._revalidate_mp_config,
+                                     daemon=True).start()
+                else:
+                    self._mp_config = self.fetch_mp_config()
+                    self._save_snapshot(self._mp_config)
+            return self._mp_config
+
+    def refresh_mp_config(self):
+        """
+        Discovers the config again, replacing the one in use.
+
+        :return: The new config
+        """
+        mp_config = self.fetch_mp_config()
+        with self._mp_config_lock:
+            self._mp_config = mp_config
+            self.from_snapshot = False
+        self._save_snapshot(mp_config)
+        return mp_config
+
+    def _revalidate_mp_config(self):
+        try:
+            self.refresh_mp_config()
+        except Exception as e:
+            log.warning("Failed to revalidate the Micropub config: %r", e)
+
+    def _load_snapshot(self):
+        if not self.config_snapshot:
+            return None
+        try:
+            with open(self.config_snapshot, encoding="utf-8") as fh:
+                snapshot = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if snapshot.get("endpoint") != self.endpoint:
+            return None
+        log.debug("Using the Micropub config from %s", self.config_snapshot)
+        return snapshot.get("mp_config")
+
+    def _save_snapshot(self, mp_config):
+        if not self.config_snapshot:
+            return
+        snapshot = {"endpoint": self.endpoint, "saved_at": time(),
+                    "mp_config": mp_config}
+        # Written aside and moved, the background revalidation may be cut
+        # short by the end of the run.
+        tmp_path = "{}.{}.tmp".format(self.config_snapshot, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump(snapshot, fh)
+        os.replace(tmp_path, self.config_snapshot)
 
     def fetch_mp_config(self):
         log.debug("Discovering Micropub config")
         url = self.endpoint + "?" + urlencode({"q": "config"})
         request = Request(url, headers=self.headers)
-        mp_config = urlopen(request).read().decode("utf-8")
-        mp_config = json.loads(mp_config)
+        mp_config = with_retries(lambda: self.pool.urlopen(request).read(),
+                                 "Micropub config discovery")
+        mp_config = json.loads(mp_config.decode("utf-8"))
         return mp_config
 
+    def open_instagram(self, url):
+        """
+        Opens an Instagram URL through the shared pool and rate limiter.
+        """
+        return _open_instagram(url, self.pool, self.ig_limiter)
+
+
+def _line_at(text, index):
+    """
+    :return: The line of `text` that contains the position `index`
+    """
+    start = text.rfind("\n", 0, index) + 1
+    end = text.find("\n", index)
+    return text[start:] if end == -1 else text[start:end]
+
+
+def _sidecar_urls(embed_html):
+    """
+    Finds the `s.handle(...)` payload of the embed page, wherever it is, and
+    extracts the largest picture of each carousel item from it.
+    """
+    for match in HANDLE_RE.finditer(embed_html):
+        try:
+            data = json.loads(match.group(1))
+            data = json.loads(data["require"][1][3][0]["contextJSON"])
+            media = data["context"]["media"]
+        except (ValueError, LookupError, TypeError):
+            continue
+        sidecar = media.get("edge_sidecar_to_children") or {}
+        return [edge["node"]["display_resources"][-1]["src"]
+                for edge in sidecar.get("edges", [])
+                if "display_resources" in edge["node"]]
+    return []
+
 
 class IGPost:
     """
     A wrapper around the IG bare HTML JSON structure, in order to strip out
     the attributes we care for.
     """
+    __slots__ = ("code", "video", "video_url", "text", "picture_urls",
+                 "publish_date")
+
     def __init__(self, node):
         self.code = node["code"]
         self.video = node["is_video"]
+        self.video_url = node.get("video_url")
         self.text = node["text"]
 
         # If carousel_urls exist, then that will contain the main photo
-        # already, so no need to use both
-        if "carousel_urls" in node:
+        # already, so no need to use both. The HAR nodes have an empty list
+        # for single pictures.
+        if node.get("carousel_urls"):
             self.picture_urls = node["carousel_urls"]
         else:
             self.picture_urls = [node["image_url"]]
@@ -141,56 +1314,88 @@ class IGPost:
         self.publish_date = publish_date
 
     @classmethod
-    def fetch_ig_post_data(cls, pub_url):
-        detail_html = cls.fetch_html(pub_url)
-        embed_html = cls.fetch_html(urljoin(pub_url, "embed/"))
-        pic_data = cls.parse(detail_html, embed_html)
-        code = pub_url.split("/")[-2]
-        pic_data["code"] = code
+    def fetch_ig_post_data(cls, pub_url, pool=None, limiter=None,
+                           page_cache=None):
+        detail_html = cls.fetch_html(pub_url, pool, limiter, page_cache)
+        embed_html = cls.fetch_html(urljoin(pub_url, "embed/"), pool, limiter,
+                                    page_cache)
+        return cls.post_data(pub_url, detail_html, embed_html)
+
+    @classmethod
+    def post_data(cls, pub_url, detail_html, embed_html):
+        with metrics.timer("parse"):
+            pic_data = cls.parse(detail_html, embed_html)
+        pic_data["code"] = shortcode(pub_url)
         pic_data["post_url"] = pub_url
         return pic_data
 
     @classmethod
-    def fetch_html(cls, url):
-        log.debug("Reading Instagram: {}".format(url))
-        req = Request(url, headers=REQ_HEADERS)
-        raw_html = urlopen(req).read().decode("utf-8")
-        return raw_html
+    def fetch_html(cls, url, pool=None, limiter=None, page_cache=None):
+        """
+        :param page_cache: Optional PageCache to serve and revalidate the
+            page from
+        """
+        headers = REQ_HEADERS
+        cached = page_cache.get(url) if page_cache is not None else None
+        if cached is not None:
+            if cached[3]:
+                log.debug("Reading Instagram from cache: %s", url)
+                metrics.count("page_cache_hits")
+                return cached[0].decode("utf-8")
+            headers = dict(REQ_HEADERS, **page_cache.conditional_headers(cached))
+
+        log.debug("Reading Instagram: %s", url)
+        req = Request(url, headers=headers)
+        try:
+            with metrics.timer("ig_fetch"):
+                response = _open_instagram(req, pool, limiter)
+                raw_html = response.read()
+            status = response.status
+        except HTTPError as e:
+            # urllib raises for a 304, the pool returns it
+            if e.code != 304 or cached is None:
+                raise
+            status = 304
+        if status == 304:
+            log.debug("Not modified: %s", url)
+            metrics.count("page_cache_revalidated")
+            page_cache.revalidated(url)
+            return cached[0].decode("utf-8")
+
+        metrics.count("ig_fetch_bytes", len(raw_html))
+        if page_cache is not None:
+            page_cache.store(url, raw_html, response.headers)
+        return raw_html.decode("utf-8")
 
     @classmethod
     def parse(cls, raw_html, embed_html):
         """
+        Each page is scanned once with the precompiled patterns, without
+        splitting it in lines.
+
         :param raw_html: raw HTML for the detail page
         :param embed_html: raw HTML for the embed page
         :return: Dict with user's data
         """
         description, img_url, is_video = None, None, False
-        for line in raw_html.split("\n"):
-            if "og:title" in line:
-                description = line.split('"og:title"')[1][10:].split('"')[0]
-                description = unescape(description)
-                description = description.split(": ")[1].strip('"')
-                break
+        match = OG_TITLE_RE.search(raw_html)
+        if match:
+            description = unescape(match.group(1))
+            description = description.split(": ", 1)[1].strip('"')
 
         img_urls = []
-        # Iterate for the main image
-        for line in embed_html.split("\n"):
-            if "EmbeddedMediaImage" in line:
-                img_url = line.split("src=")[2][1:].split('"')[0]
-                img_url = unescape(img_url)
+        # The main image is the second src= of the EmbeddedMediaImage line,
+        # the first one belongs to the avatar.
+        index = embed_html.find("EmbeddedMediaImage")
+        if index != -1:
+            line = _line_at(embed_html, index)
+            srcs = SRC_RE.findall(line)
+            if len(srcs) > 1:
+                img_url = unescape(srcs[1])
                 img_urls.append(img_url)
-                break
 
         # Now look for additional images in the post
-        line = embed_html.split("\n")[11]
-        js_content = re.sub(r'<script[^>]*>(.*?)', "", line, re.DOTALL)
-        js_content = re.search(r's\.handle\((.*?)\);requireLazy', js_content, re.DOTALL)
-        if js_content:
-            data = json.loads(js_content.group(1))
-            data = json.loads(data["require"][1][3][0]["contextJSON"])
-            edges = data['context']['media']['edge_sidecar_to_children']['edges']
-            more_pics = [edge['node']["display_resources"][-1]["src"] for edge in edges if "display_resources" in edge["node"]]
-            img_urls.extend(more_pics)
+        img_urls.extend(_sidecar_urls(embed_html))
 
         assert img_url is not None, "No image found from Instagram post HTML."
         result = {
@@ -204,10 +1409,33 @@ class IGPost:
         return result
 
     @classmethod
-    def from_url(cls, post_url):
-        post_data = cls.fetch_ig_post_data(post_url)
+    def from_url(cls, post_url, pool=None, limiter=None, page_cache=None):
+        post_data = cls.fetch_ig_post_data(post_url, pool, limiter, page_cache)
         return cls(post_data)
 
+    @classmethod
+    def from_profile_node(cls, node):
+        """
+        Use this with the nodes from `extract_pictures`.
+
+        :return: The IGPost, or None for carousels whose pictures aren't in
+            the profile page
+        """
+        children = (node.get("edge_sidecar_to_children") or {}).get("edges")
+        if node.get("__typename") == "GraphSidecar" and not children:
+            return None
+        captions = (node.get("edge_media_to_caption") or {}).get("edges")
+        return cls({
+            "code": node["shortcode"],
+            "text": captions[0]["node"]["text"] if captions else "",
+            "is_video": node.get("is_video", False),
+            "video_url": node.get("video_url"),
+            "image_url": node["display_url"],
+            "carousel_urls": [child["node"]["display_url"]
+                              for child in children or ()],
+            "created_at": node.get("taken_at_timestamp"),
+        })
+
     @classmethod
     def from_filtered_node(cls, node) -> "IGPost":
         """
@@ -227,15 +1455,172 @@ class Post:
 
     def upload_media(self, site):
         log.debug("Downloading images from Instagram")
-        uploaded_urls = []
-        for picture_url in self.ig_post.picture_urls:
-            media_fh = urlopen(picture_url)
-            filename = basename(urlparse(picture_url).path)
-            photo_url = self.post_media(site, media_fh, filename)
-            uploaded_urls.append(photo_url)
-        return uploaded_urls
-
-    def build_body(self, uploaded_urls, syndicate):
+        picture_urls = self.ig_post.picture_urls
+
+        def transfer(url):
+            return self.checkpointed(site, url,
+                                     lambda: self.transfer_picture(site, url))
+
+        workers = max(1, min(site.media_workers, len(picture_urls)))
+        if workers == 1:
+            return [transfer(url) for url in picture_urls]
+
+        from concurrent.futures import ThreadPoolExecutor
+        # Each picture is downloaded and uploaded on its own thread, map()
+        # returns them in the picture_urls order so the main photo is first.
+        # A failed picture doesn't stop the others, they are checkpointed
+        # before the error is raised.
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(transfer, picture_urls))
+
+    def checkpointed(self, site, source_url, transfer):
+        """
+        Calls `transfer` to upload the media at `source_url`, unless the
+        ledger has it uploaded for this post by an earlier attempt. The
+        uploaded URL is recorded in the ledger straight away, so a post that
+        fails afterwards only uploads the media still missing next time.
+
+        :return: URL of the uploaded file
+        """
+        ledger = site.ledger
+        if ledger is None:
+            return transfer()
+        location = ledger.uploaded_media(self.ig_post.code).get(source_url)
+        if location:
+            log.debug("Uploaded by an earlier attempt: %s", source_url)
+            metrics.count("media_resumed")
+            return location
+        location = transfer()
+        ledger.record_media(self.ig_post.code, source_url, location)
+        return location
+
+    def transfer_picture(self, site, picture_url):
+        """
+        Downloads a single picture from Instagram into the media endpoint.
+
+        :return: URL of the uploaded file
+        """
+        filename = basename(urlparse(picture_url).path)
+        # A download cut short raises IncompleteRead, from MultipartBody
+        # or MediaCache.store
+        dropped = (ConnectionError, TimeoutError, IncompleteRead)
+
+        def transfer():
+            def stream():
+                # The download is streamed into the upload, only the time
+                # to the response headers counts as image_download.
+                with metrics.timer("image_download"):
+                    media_fh = site.open_instagram(picture_url)
+                with media_fh:
+                    return self.post_media(site, media_fh, filename)
+
+            # A streamed upload can't be sent again, a failed one downloads
+            # the picture again too.
+            return with_retries(stream, "Transfer of " + filename,
+                                errors=dropped)
+
+        if site.media_cache is None:
+            return transfer()
+
+        def store():
+            def download():
+                with metrics.timer("image_download"), \
+                        site.open_instagram(picture_url) as response:
+                    return site.media_cache.store(picture_url, response)
+
+            return with_retries(download, "Download of " + filename,
+                                errors=dropped), None
+
+        return self.transfer_cached(
+            site, picture_url, store,
+            lambda media_fh, mime_type: self.post_media(site, media_fh,
+                                                        filename),
+            transfer)
+
+    def transfer_video(self, site):
+        """
+        Downloads the video of the post into a temporary file, in chunks and
+        resuming dropped transfers, then streams it to the media endpoint.
+        Only one chunk is held in memory at a time.
+
+        :return: URL of the uploaded video
+        """
+        video_url = self.ig_post.video_url
+        filename = basename(urlparse(video_url).path)
+
+        def transfer():
+            with TemporaryFile() as media_fh:
+                mime_type = self.download_video(site, media_fh)
+                return self.post_media(site, media_fh, filename, mime_type)
+
+        if site.media_cache is None:
+            return transfer()
+
+        def store():
+            with TemporaryFile() as video_fh:
+                mime_type = self.download_video(site, video_fh)
+                return site.media_cache.store(video_url, video_fh), mime_type
+
+        def upload(media_fh, mime_type):
+            mime_type = mime_type or video_mime_type(None, filename)
+            return self.post_media(site, media_fh, filename, mime_type)
+
+        return self.transfer_cached(site, video_url, store, upload, transfer)
+
+    def transfer_cached(self, site, source_url, store, upload, transfer):
+        """
+        Transfers the media at `source_url` through the site's media cache,
+        skipping the upload when it, or the same contents, was uploaded
+        before, and the download when the bytes are still cached.
+
+        :param store: Downloads the media into the cache, returning
+            (its digest, mime type or None)
+        :param upload: Uploads an open cached file, given the mime type
+            from `store` or None when it was cached by an earlier transfer
+        :param transfer: Downloads and uploads the media without the cache,
+            for when the cached file is evicted before it is uploaded
+        :return: URL of the uploaded file
+        """
+        cache = site.media_cache
+        digest, location = cache.lookup(source_url) or (None, None)
+        if location:
+            log.debug("Already uploaded: %s", source_url)
+            return location
+
+        mime_type = None
+        media_fh = cache.open(digest) if digest else None
+        if media_fh is None:
+            digest, mime_type = store()
+            location = cache.location(digest)
+            if location:
+                log.debug("Same contents already uploaded: %s", source_url)
+                return location
+            media_fh = cache.open(digest)
+
+        if media_fh is None:
+            # Evicted by another transfer before it could be uploaded
+            location = transfer()
+        else:
+            with media_fh:
+                location = upload(media_fh, mime_type)
+        cache.set_location(digest, location)
+        return location
+
+    def download_video(self, site, fh):
+        """
+        Downloads the post's video into `fh` and rewinds it.
+
+        :return: The video mime type
+        """
+        video_url = self.ig_post.video_url
+        log.debug("Downloading video from Instagram: %s", video_url)
+        with metrics.timer("video_download"):
+            content_type = download_resumable(site.open_instagram, video_url, fh)
+        metrics.count("video_download_bytes", fh.tell())
+        fh.seek(0)
+        return video_mime_type(content_type, basename(urlparse(video_url).path))
+
+    def build_body(self, uploaded_urls, syndicate, video_url=None):
         post_content = self.ig_post.text
         main_photo, more_photos = uploaded_urls[0], uploaded_urls[1:]
         if more_photos:
@@ -248,6 +1633,8 @@ class Post:
             "photo": main_photo,
             "syndication": DETAIL_URL.format(self.ig_post.code),
         }
+        if video_url:
+            unique_keys["video"] = video_url
         multi_keys = []
         if syndicate:
             multi_keys = [
@@ -261,61 +1648,531 @@ class Post:
             body.append(("published", publish_date))
         return body
 
-    def post_media(self, site, media_fh, filename):
+    def post_media(self, site, media_fh, filename, mime_type="image/jpeg"):
         media_endpoint = site.mp_config["media-endpoint"]
-        photo_url = _upload_media(media_endpoint, media_fh, site.token, filename)
+        photo_url = _upload_media(media_endpoint, media_fh, site.token,
+                                  filename, mime_type, pool=site.pool)
         return photo_url
 
+    def to_plan(self, syndicate):
+        """
+        :return: JSON serializable dict with what `post` would publish, the
+            entry `body` has the Instagram URLs of the media still.
+        """
+        picture_urls = self.ig_post.picture_urls
+        video_url = self.ig_post.video_url
+        body = {}
+        for key, value in self.build_body(picture_urls, syndicate, video_url):
+            if key in body:
+                value = (body[key] if isinstance(body[key], list)
+                         else [body[key]]) + [value]
+            body[key] = value
+        return {
+            "code": self.ig_post.code,
+            "text": self.ig_post.text,
+            "picture_urls": picture_urls,
+            "video_url": video_url,
+            "publish_date": (self.publish_date.isoformat()
+                             if self.publish_date else None),
+            "syndicate": syndicate,
+            "body": body,
+        }
+
+    @classmethod
+    def from_plan(cls, entry):
+        """
+        Rebuilds a post from a `to_plan` dict. The `body` is only there for
+        review, the entry is built again from the other fields.
+        """
+        picture_urls = entry["picture_urls"]
+        ig_post = IGPost({
+            "code": entry["code"],
+            "text": entry["text"],
+            "is_video": bool(entry.get("video_url")),
+            "video_url": entry.get("video_url"),
+            "image_url": picture_urls[0] if picture_urls else None,
+            "carousel_urls": picture_urls,
+        })
+        publish_date = entry.get("publish_date")
+        if publish_date:
+            publish_date = datetime.fromisoformat(publish_date)
+        return cls(ig_post, publish_date)
+
     def print(self, site, syndicate):
-        body = self.build_body(self.ig_post.picture_urls, False)
+        body = self.build_body(self.ig_post.picture_urls, False,
+                               self.ig_post.video_url)
         body = dict(body)
-        log.debug("Would post to: {}".format(site.endpoint))
-        log.debug("Text: {}".format(body["content"]))
-        log.debug("Syndicate: {}".format(syndicate))
-        log.debug("Photos to post:")
-        log.debug("\n".join(self.ig_post.picture_urls))
+        log.info("Would post to: %s", site.endpoint)
+        log.info("Text: %s", body["content"])
+        log.info("Syndicate: %s", syndicate)
+        log.info("Photos to post:")
+        log.info("\n".join(self.ig_post.picture_urls))
+        if self.ig_post.video_url:
+            log.info("Video to post: %s", self.ig_post.video_url)
         if not self.publish_date:
-            log.debug("No Date, will use today")
+            log.info("No Date, will use today")
         else:
-            log.debug("Publish as: {}".format(self.publish_date))
+            log.info("Publish as: %s", self.publish_date)
 
     def post(self, site, syndicate):
+        return self.publish(site, syndicate, self.upload(site))
+
+    def upload(self, site):
+        """
+        Transfers all the media of the post to the media endpoint.
+
+        :return: (uploaded picture URLs, uploaded video URL or None)
+        """
+        media_endpoint = site.mp_config["media-endpoint"]
+        try:
+            return self._upload(site)
+        except (HTTPError, ConnectionError):
+            if site.from_snapshot:
+                # The saved config may be outdated, discover it again
+                log.warning("Upload failed with the saved Micropub config, "
+                            "discovering it again")
+                site.refresh_mp_config()
+            if site.mp_config["media-endpoint"] == media_endpoint:
+                raise
+            return self._upload(site)
+
+    def _upload(self, site):
         uploaded_urls = self.upload_media(site)
-        body = self.build_body(uploaded_urls, syndicate)
-        log.debug("Posting to {}".format(site.endpoint))
+        video_url = None
+        if self.ig_post.video_url:
+            video_url = self.checkpointed(site, self.ig_post.video_url,
+                                          lambda: self.transfer_video(site))
+        return uploaded_urls, video_url
+
+    def publish(self, site, syndicate, media):
+        """
+        Creates the entry once its media is uploaded.
+
+        :param media: What `upload` returned
+        :return: URL of the entry, or the reason it was not created
+        """
+        uploaded_urls, video_url = media
+        body = self.build_body(uploaded_urls, syndicate, video_url)
+        log.debug("Posting to %s", site.endpoint)
         body = urlencode(body, doseq=True).encode("utf-8")
         request = Request(site.endpoint, data=body, headers=site.headers)
-        response = urlopen(request)
+
+        def send():
+            with metrics.timer("entry_post"), \
+                    site.pool.urlopen(request) as response:
+                response.read()
+            return response
+
+        # Only the errors answered by the server are retried. A connection
+        # lost or timed out once the body is sent may have created the entry
+        # already, sending it again would publish it twice.
+        try:
+            response = with_retries(send, "Entry of " + self.ig_post.code,
+                                    errors=())
+        except (ConnectionError, TimeoutError):
+            log.error("No response to the entry of %s, it may have been "
+                      "created: check %s before publishing it again",
+                      self.ig_post.code, site.endpoint)
+            raise
         if response.status == 201:
             post_url = response.headers.get("Location")
-            log.debug("Uploaded: {}".format(post_url))
+            log.debug("Uploaded: %s", post_url)
+            metrics.count("posts_published")
+            if site.ledger is not None:
+                media_urls = uploaded_urls + ([video_url] if video_url else [])
+                site.ledger.record(self.ig_post.code, post_url, media_urls)
             return post_url
         else:
             return response.reason
 
 
-def post_single_ig_post(site, pub_url, publish_date, syndicate, commit):
+class PlanWriter:
+    """
+    Writes the posts of a dry run as a plan, one JSON object per line, that
+    `apply_plan` can publish later without fetching or parsing anything.
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+        self._lock = threading.Lock()
+
+    def write(self, post, syndicate):
+        line = json.dumps(post.to_plan(syndicate), ensure_ascii=False) + "\n"
+        with self._lock:
+            self.fh.write(line)
+            self.fh.flush()
+
+
+def read_plan(fh):
+    """
+    :return: Generator of (Post, syndicate) for each line of a plan
+    """
+    for line in fh:
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        yield Post.from_plan(entry), entry.get("syndicate", False)
+
+
+def open_plan(path, mode):
+    """
+    Opens a plan file, "-" being stdin or stdout. Closing those is a no-op.
+    """
+    if path == "-":
+        std = sys.stdin if "r" in mode else sys.stdout
+        return open(std.fileno(), mode, encoding="utf-8", closefd=False)
+    return open(path, mode, encoding="utf-8")
+
+
+def apply_plan(site, fh, window=PUBLISH_WINDOW):
+    """
+    Publishes the posts of a plan in the order they were planned, skipping
+    the ones the ledger knows about.
+
+    :return: The failures, as in `publish_in_order`
+    """
+    def unpublished():
+        for post, syndicate in read_plan(fh):
+            if site.ledger is not None and post.ig_post.code in site.ledger:
+                log.info("Already published, skipping: %s", post.ig_post.code)
+                metrics.count("posts_skipped")
+                continue
+            yield post, syndicate
+
+    return publish_in_order(site, unpublished(), window)
+
+
+def publish_in_order(site, posts, window=PUBLISH_WINDOW):
+    """
+    Publishes the posts in the given order while the media of the next
+    `window` posts uploads concurrently. The uploads finish in any order
+    but the entries are created one after the other, each one as soon as
+    its media and every earlier entry are done.
+
+    A post that fails is logged and left out, the rest carry on.
+
+    :param posts: Iterable of (Post, syndicate)
+    :return: List of (Post, exception) for the posts that failed
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    failures = []
+    posts = iter(posts)
+    # Reorder buffer, the futures of the uploads in publishing order
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(1, window)) as executor:
+        def fill():
+            while len(pending) < max(1, window):
+                try:
+                    post, syndicate = next(posts)
+                except StopIteration:
+                    return
+                pending.append((post, syndicate,
+                                executor.submit(post.upload, site)))
+
+        fill()
+        while pending:
+            post, syndicate, upload = pending.popleft()
+            try:
+                post.publish(site, syndicate, upload.result())
+            except Exception as e:
+                log.error("Failed to publish %s: %r", post.ig_post.code, e)
+                metrics.count("posts_failed")
+                failures.append((post, e))
+            fill()
+    return failures
+
+
+def post_single_ig_post(site, pub_url, publish_date, syndicate, commit,
+                        plan=None):
+    if site.ledger is not None and shortcode(pub_url) in site.ledger:
+        log.info("Already published, skipping: %s", pub_url)
+        metrics.count("posts_skipped")
+        return
+
     # A single IG post can have multiple pictures.
-    ig_post = IGPost.from_url(pub_url)
+    ig_post = IGPost.from_url(pub_url, site.pool, site.ig_limiter,
+                              site.page_cache)
+    publish_ig_post(site, ig_post, publish_date, syndicate, commit, plan)
+
+
+def publish_ig_post(site, ig_post, publish_date, syndicate, commit,
+                    plan=None):
+    """
+    :param plan: PlanWriter the dry runs are written to
+    """
     publish_date = publish_date or ig_post.publish_date
     post = Post(ig_post, publish_date)
     if commit:
         post.post(site, syndicate)
     else:
         post.print(site, syndicate)
+        if plan is not None:
+            plan.write(post, syndicate)
+
+
+async def fetch_ig_post_async(pub_url, site, in_flight):
+    """
+    Fetches the detail and embed pages of a post at the same time.
+
+    :param in_flight: asyncio.Semaphore capping the page fetches in flight
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+
+    async def fetch(url):
+        async with in_flight:
+            return await loop.run_in_executor(
+                None, IGPost.fetch_html, url, site.pool, site.ig_limiter,
+                site.page_cache)
+
+    detail_html, embed_html = await asyncio.gather(
+        fetch(pub_url), fetch(urljoin(pub_url, "embed/")))
+    return IGPost(IGPost.post_data(pub_url, detail_html, embed_html))
+
+
+async def run_batch(site, publication_urls, publish_date, syndicate, commit,
+                    concurrency, plan=None):
+    """
+    Fetches many posts concurrently, with at most `concurrency` Instagram
+    pages in flight, and publishes each one as soon as it has been parsed.
+    Posts are published in the order they finish fetching.
+
+    :return: List of (post URL, exception) for the posts that failed
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    loop = asyncio.get_running_loop()
+    # The page fetches run on the default executor and the publishing on
+    # its own threads, so uploading posts never holds back the fetches.
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    publisher = ThreadPoolExecutor(max_workers=concurrency)
+    in_flight = asyncio.Semaphore(concurrency)
+
+    async def fetch_and_publish(pub_url):
+        try:
+            ig_post = await fetch_ig_post_async(pub_url, site, in_flight)
+            await loop.run_in_executor(publisher, publish_ig_post, site,
+                                       ig_post, publish_date, syndicate,
+                                       commit, plan)
+        except Exception as e:
+            log.error("Failed to publish %s: %r", pub_url, e)
+            metrics.count("posts_failed")
+            return pub_url, e
+
+    tasks = []
+    for pub_url in publication_urls:
+        if site.ledger is not None and shortcode(pub_url) in site.ledger:
+            log.info("Already published, skipping: %s", pub_url)
+            metrics.count("posts_skipped")
+            continue
+        tasks.append(fetch_and_publish(pub_url))
+    with publisher:
+        results = await asyncio.gather(*tasks)
+    return [failure for failure in results if failure]
 
 
-def run_script(config, publication_urls, publish_date, syndicate, commit):
+def sync_profile(site, user, mark, syndicate, commit, plan=None,
+                 profile_url=PROFILE_URL, window=PUBLISH_WINDOW,
+                 published=None):
+    """
+    A single watch cycle: reads the profile page and publishes, oldest
+    first, the posts newer than the high-water mark.
+
+    :param mark: {"code", "taken_at"} of the newest post already handled,
+        None on the first cycle which only sets it
+    :param published: {shortcode: taken_at} of the posts published by
+        earlier cycles past the mark, updated in place. They are skipped
+        like the ones in the ledger, which may not be there.
+    :return: The new high-water mark. It stops before the first post that
+        failed, so that one is tried again on the next cycle.
+    """
+    if published is None:
+        published = {}
+    url = profile_url.format(user)
+    with metrics.timer("profile_fetch"):
+        html = IGPost.fetch_html(url, site.pool, site.ig_limiter)
+    nodes = extract_pictures(profile_payload(html))
+    nodes.sort(key=lambda node: node["taken_at_timestamp"])
+    if not nodes:
+        return mark
+    if mark is None:
+        newest = nodes[-1]
+        log.info("Watching %s for posts newer than %s", user,
+                 newest["shortcode"])
+        return {"code": newest["shortcode"],
+                "taken_at": newest["taken_at_timestamp"]}
+
+    new_nodes = [node for node in nodes
+                 if node["taken_at_timestamp"] >= mark["taken_at"]
+                 and node["shortcode"] != mark["code"]]
+    posts = []
+    for node in new_nodes:
+        if node["shortcode"] in published:
+            continue
+        if site.ledger is not None and node["shortcode"] in site.ledger:
+            continue
+        ig_post = IGPost.from_profile_node(node)
+        if ig_post is None:
+            # Carousel pictures are only in the post pages
+            detail_url = urljoin(url, "/p/{}/".format(node["shortcode"]))
+            ig_post = IGPost.from_url(detail_url, site.pool, site.ig_limiter,
+                                      site.page_cache)
+        posts.append(Post(ig_post, ig_post.publish_date))
+    log.info("Found %d new posts from %s", len(posts), user)
+    metrics.count("watch_new_posts", len(posts))
+
+    failed = set()
+    if commit:
+        failures = publish_in_order(
+            site, ((post, syndicate) for post in posts), window)
+        failed = {post.ig_post.code for post, _ in failures}
+        for node in new_nodes:
+            if node["shortcode"] not in failed:
+                published[node["shortcode"]] = node["taken_at_timestamp"]
+    else:
+        for post in posts:
+            post.print(site, syndicate)
+            if plan is not None:
+                plan.write(post, syndicate)
+
+    for node in new_nodes:
+        if node["shortcode"] in failed:
+            break
+        mark = {"code": node["shortcode"],
+                "taken_at": node["taken_at_timestamp"]}
+    # Posts before the mark are left out by the filter already
+    for code, taken_at in list(published.items()):
+        if taken_at < mark["taken_at"]:
+            del published[code]
+    return mark
+
+
+def watch_profile(site, user, interval, syndicate, commit, plan=None,
+                  profile_url=PROFILE_URL, cycles=None):
+    """
+    Polls the profile every `interval` seconds and publishes its new posts,
+    reusing the site's connections and Micropub config between cycles. The
+    high-water mark is kept in the ledger when there is one, so a restart
+    carries on where it stopped.
+
+    :param cycles: Stop after that many cycles, None runs until interrupted
+    """
+    key = "watch:" + user
+    mark = site.ledger.get_state(key) if site.ledger is not None else None
+    published = {}
+    cycle = 0
+    try:
+        while cycles is None or cycle < cycles:
+            started = monotonic()
+            try:
+                new_mark = sync_profile(site, user, mark, syndicate, commit,
+                                        plan, profile_url,
+                                        published=published)
+            except Exception as e:
+                # Try again on the next cycle
+                log.error("Watch cycle failed: %r", e)
+            else:
+                if new_mark != mark and commit and site.ledger is not None:
+                    site.ledger.set_state(key, new_mark)
+                mark = new_mark
+            cycle += 1
+            if cycles is None or cycle < cycles:
+                sleep(max(0.0, interval - (monotonic() - started)))
+    except KeyboardInterrupt:
+        log.info("Stopped watching %s", user)
+
+
+def report_failures(site, failures):
+    """
+    Logs the posts that failed during the run and why. With a ledger, the
+    media they had uploaded already is kept and a re-run only uploads the
+    rest.
+
+    :param failures: List of (post URL or shortcode, exception)
+    """
+    if not failures:
+        return
+    log.error("%d posts failed:", len(failures))
+    for name, error in failures:
+        uploaded = ""
+        if site.ledger is not None:
+            count = len(site.ledger.uploaded_media(shortcode(name)))
+            if count:
+                uploaded = " - {} media uploaded, kept for the next run".format(
+                    count)
+        log.error("  %s: %r%s", name, error, uploaded)
+
+
+def run_script(config, publication_urls, publish_date, syndicate, commit,
+               media_workers=MEDIA_WORKERS, ledger_path=None,
+               media_cache_dir=None, concurrency=1, ig_rate=IG_RATE,
+               metrics_format=None, page_cache_path=None,
+               page_ttl=PAGE_CACHE_TTL, plan_path=None, apply_path=None,
+               config_snapshot=None, watch=None, cycles=None,
+               profile_url=PROFILE_URL):
     """
     Wrapper function because we don't want anything else in the global scope.
+
+    :param metrics_format: "json" or "prometheus" to time each stage and
+        dump a summary at the end of the run
+    :param page_cache_path: sqlite3 file caching the Instagram pages, kept
+        fresh for `page_ttl` seconds
+    :param plan_path: Where the plan of a dry run is written, stdout if None
+    :param apply_path: Plan to publish instead of the `publication_urls`,
+        "-" reads it from stdin
+    :param config_snapshot: JSON file keeping the discovered Micropub config
+        between runs
+    :param watch: Seconds between polls of the config's user profile, to
+        publish its new posts instead of the `publication_urls`
+    :return: List of (post URL or shortcode, exception) for the posts that
+        failed
     """
+    metrics.enabled = bool(metrics_format)
     mp_endpoint = config["endpoint"]
     token = config["token"]
-    site = MicroPubSite(mp_endpoint, token)
-    commit = False
-    for pub_url in publication_urls:
-        post_single_ig_post(site, pub_url, publish_date, syndicate, commit)
+    ledger = Ledger(ledger_path) if ledger_path else None
+    media_cache = MediaCache(media_cache_dir) if media_cache_dir else None
+    page_cache = None
+    if page_cache_path:
+        page_cache = PageCache(page_cache_path, page_ttl)
+    site = MicroPubSite(mp_endpoint, token, media_workers, ledger, media_cache,
+                        ig_rate, page_cache, config_snapshot)
+    plan = plan_fh = None
+    failures = []
+    if apply_path:
+        with open_plan(apply_path, "r") as apply_fh:
+            failures = [(post.ig_post.code, e)
+                        for post, e in apply_plan(site, apply_fh)]
+        publication_urls = []
+    elif not commit:
+        plan_fh = open_plan(plan_path or "-", "w")
+        plan = PlanWriter(plan_fh)
+    if watch:
+        watch_profile(site, config["user"], watch, syndicate, commit, plan,
+                      profile_url, cycles)
+    elif concurrency > 1:
+        import asyncio
+        failures = asyncio.run(run_batch(site, publication_urls, publish_date,
+                                         syndicate, commit, concurrency, plan))
+    else:
+        for pub_url in publication_urls:
+            # One failed post doesn't stop the others
+            try:
+                post_single_ig_post(site, pub_url, publish_date, syndicate,
+                                    commit, plan)
+            except Exception as e:
+                log.error("Failed to publish %s: %r", pub_url, e)
+                metrics.count("posts_failed")
+                failures.append((pub_url, e))
+    if plan_fh is not None:
+        plan_fh.close()
+    report_failures(site, failures)
+    if site.ig_limiter is not None:
+        log.info("Instagram %s", site.ig_limiter.summary())
+    if metrics_format:
+        metrics.dump(metrics_format)
     log.info("Done!")
+    return failures
 
 
 def parse_args():
@@ -323,23 +2180,49 @@ def parse_args():
         prog="uGram", description="Micropub post from Instagram")
     parser.add_argument('config',
         type=argparse.FileType("r", encoding="utf-8"))
-    parser.add_argument('urls', nargs="+")
+    parser.add_argument('urls', nargs="*")
     parser.add_argument('-d', '--date', default=None)
     parser.add_argument('--commit', type=str2bool, nargs='?', const=True, default=True)
     parser.add_argument('--syndicate', type=str2bool, nargs='?', const=True, default=True)
+    parser.add_argument('--media-workers', type=int, default=MEDIA_WORKERS)
+    parser.add_argument('--ledger', default=None)
+    parser.add_argument('--media-cache', default=None)
+    parser.add_argument('--page-cache', default=None)
+    parser.add_argument('--page-ttl', type=float, default=PAGE_CACHE_TTL)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--ig-rate', type=float, default=IG_RATE)
+    parser.add_argument('--metrics', choices=["json", "prometheus"], default=None)
+    parser.add_argument('--plan', default=None)
+    parser.add_argument('--apply', default=None)
+    parser.add_argument('--config-snapshot', default=None)
+    parser.add_argument('--watch', type=float, default=None)
+    parser.add_argument('--cycles', type=int, default=None)
+    parser.add_argument('--profile-url', default=PROFILE_URL)
+    parser.add_argument('-v', '--verbose', action="store_true")
     args = parser.parse_args()
+    if not args.urls and not args.apply and not args.watch:
+        parser.error("give at least one Instagram post URL, --apply a plan "
+                     "or --watch the profile")
     return args
 
 
 def main():
     args = parse_args()
+    log.basicConfig(level=log.DEBUG if args.verbose else log.INFO)
     config = json.load(args.config)
     publish_date = datetime.fromisoformat(args.date) if args.date else None
     publication_urls = args.urls
     syndicate = args.syndicate
     commit = args.commit
 
-    run_script(config, publication_urls, publish_date, syndicate, commit)
+    failures = run_script(config, publication_urls, publish_date, syndicate,
+                          commit, args.media_workers, args.ledger,
+                          args.media_cache, args.concurrency, args.ig_rate,
+                          args.metrics, args.page_cache, args.page_ttl,
+                          args.plan, args.apply, args.config_snapshot,
+                          args.watch, args.cycles, args.profile_url)
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -350,19 +2233,49 @@ if __name__ == "__main__":
 
     Usage:
         python ugram.py config.json <IG_POST_URL> [<IG_POST_URL> ...] [OPTIONS]
+        python ugram.py config.json --apply PLAN [OPTIONS]
+        python ugram.py config.json --watch SECONDS [OPTIONS]
 
     Arguments:
         config       Path to JSON config file with 'endpoint', 'token', and 'user' fields
-        urls         One or more Instagram post URLs to publish
+        urls         One or more Instagram post URLs to publish, unless applying a plan
 
     Options:
         -d, --date DATE       Publish date in ISO format (YYYY-MM-DD). Defaults to post's original date
         --commit BOOL         Whether to actually post (True) or dry-run (False). Default: True
+                              A dry-run writes its plan, one JSON post per line, to stdout
+        --plan PATH           Write the plan of a dry-run to PATH instead of stdout
+        --apply PLAN          Publish the posts of a plan written by a dry-run, "-" for stdin.
+                              Nothing is fetched from Instagram but the media
         --syndicate BOOL      Whether to syndicate to configured platforms. Default: True
+        --media-workers N     Carousel pictures transferred concurrently. Default: 4
+        --ledger PATH         sqlite3 file recording what was published, to skip it on re-runs
+        --media-cache DIR     Directory caching the media transferred, to not upload it twice
+        --page-cache PATH     sqlite3 file caching the Instagram pages, revalidated with
+                              ETag/Last-Modified once older than --page-ttl
+        --page-ttl SECONDS    Seconds a cached page is used without asking Instagram.
+                              Default: 86400
+        --concurrency N       Instagram pages fetched at the same time, >1 enables the
+                              asyncio batch mode. Default: 1
+        --ig-rate RATE        Initial requests/s per Instagram host, 0 disables the
+                              rate limiting. Default: 2
+        --metrics FORMAT      Time each stage and print a json or prometheus summary
+                              to stderr at the end
+        --config-snapshot PATH  JSON file keeping the discovered Micropub config between
+                              runs. It is used right away and revalidated in the background
+        --watch SECONDS       Poll the config's user profile every SECONDS and publish its
+                              new posts. The newest post seen is kept in the --ledger
+        --cycles N            Stop watching after N polls. Default: run until interrupted
+        --profile-url URL     Profile page template, {} is the user.
+                              Default: https://www.instagram.com/{}
+        -v, --verbose         Debug logging
 
     Examples:
         python ugram.py config.json https://www.instagram.com/p/ABC123/
         python ugram.py config.json https://www.instagram.com/p/ABC123/ --commit=False
+        python ugram.py config.json https://www.instagram.com/p/ABC123/ --commit=False --plan plan.ndjson
+        python ugram.py config.json --apply plan.ndjson
+        python ugram.py config.json --watch 300 --ledger ledger.sqlite3
         python ugram.py config.json https://www.instagram.com/p/ABC123/ -d 2024-01-15 --syndicate=False
     """
     main()